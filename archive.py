@@ -0,0 +1,555 @@
+#!/usr/local/bin/python3
+# Copyright (C) 2015-2025 Wang,Jing   <jingwangian@gmail.com>
+#
+# This file is part of Flight Inforation Query System (fiqs)
+#
+# fiqs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fiqs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fiqs.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Segment archive of the raw result pages.
+
+A segment file holds many pages, every record is:
+    record header   struct '>2sBHI' : b'PG', compression, header_len, body_len
+    header          header_len bytes, the <flight_id>, <url>, <search_date>
+                    and <worker_num> lines of the result file, not compressed
+    body            body_len bytes, the page text compressed
+An open segment is named xxx.seg_ and renamed to xxx.seg when it is sealed.
+Every segment has an offset index xxx.idx with one struct '>iiQI' entry
+per record: flight_id, search_date as yyyymmdd, offset, record length.
+"""
+
+import os
+import sys
+import gzip
+import mmap
+import time
+import struct
+import datetime
+import collections
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESS_NONE = 0
+COMPRESS_GZIP = 1
+COMPRESS_ZSTD = 2
+
+SEGMENT_MAGIC = b'FIQSSEG1'
+
+record_header = struct.Struct('>2sBHI')
+index_entry = struct.Struct('>iiQI')
+
+Record = collections.namedtuple('Record',
+            ['flight_id','url','search_date','worker_num','offset','length','body'])
+
+RawRecord = collections.namedtuple('RawRecord',
+            ['flight_id','url','search_date','worker_num','offset','length','method','data'])
+
+def compress(data, method):
+    if method == COMPRESS_ZSTD:
+        return zstandard.ZstdCompressor().compress(data)
+    elif method == COMPRESS_GZIP:
+        return gzip.compress(data, 6)
+    return data
+
+def decompress(data, method):
+    if method == COMPRESS_ZSTD:
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif method == COMPRESS_GZIP:
+        return gzip.decompress(data)
+    return bytes(data)
+
+def default_compression():
+    if zstandard != None:
+        return COMPRESS_ZSTD
+    return COMPRESS_GZIP
+
+def date_to_int(search_date):
+    """
+    '2016-06-02 10 05 33' or '2016-06-02' -> 20160602
+    """
+    return int(search_date[0:10].replace('-',''))
+
+def make_header(flight_id, url, search_date, worker_num):
+    return ("<flight_id>%s\n<url>%s\n<search_date>%s\n<worker_num>%s\n"
+            %(flight_id,url,search_date,worker_num)).encode()
+
+def parse_header(header):
+    """
+    Return (flight_id, url, search_date, worker_num) of a record header
+    """
+    fields = dict()
+    for line in bytes(header).decode().split('\n'):
+        if line.startswith('<') and '>' in line:
+            k,v = line[1:].split('>',maxsplit=1)
+            fields[k] = v
+    return (fields.get('flight_id'), fields.get('url'),
+            fields.get('search_date'), fields.get('worker_num'))
+
+def index_name(segment_name):
+    if segment_name.endswith('_'):
+        segment_name = segment_name[:-1]
+    return segment_name[:-len('.seg')]+'.idx'
+
+class SegmentWriter():
+    """
+    Append the pages into segment files in dir_name named
+    <prefix>_<yyyymmdd>_<pid>_<hhmmss>_<seq>.seg. A segment is sealed (renamed from
+    .seg_ to .seg) when it reaches max_size bytes or max_records records,
+    when it is older than max_age seconds, and by close().
+    One writer is used by one process only.
+    """
+    def __init__(self, dir_name='archive', prefix='seg', max_size=256*1024*1024,
+                 max_records=100000, max_age=0, compression=None):
+        self.dir_name = dir_name
+        self.prefix = prefix
+        self.max_size = max_size
+        self.max_records = max_records
+        self.max_age = max_age
+        if compression == None:
+            compression = default_compression()
+        self.compression = compression
+        self.seq = 0
+        self.f = None
+        self.idx_f = None
+        self.open_time = None
+        self.record_num = 0
+        os.makedirs(dir_name, exist_ok=True)
+
+    def open_segment(self):
+        # The time keeps the names unique when a pid is reused, the
+        # segments are moved out of dir_name once they are ingested
+        now = datetime.datetime.now()
+        d = now.strftime('%Y%m%d')
+        t = now.strftime('%H%M%S')
+        while True:
+            self.seq += 1
+            name = "%s_%s_%d_%s_%d.seg" %(self.prefix,d,os.getpid(),t,self.seq)
+            path = os.path.join(self.dir_name, name)
+            if not os.path.exists(path) and not os.path.exists(path+'_'):
+                break
+        self.path = path
+        self.f = open(path+'_','wb')
+        self.f.write(SEGMENT_MAGIC)
+        self.idx_f = open(index_name(path),'wb')
+        self.open_time = time.time()
+        self.record_num = 0
+
+    def append(self, flight_id, url, search_date, worker_num, body):
+        """
+        Append one page, body is the page text as str or bytes.
+        Return (segment path, offset) of the record.
+        """
+        if self.f == None:
+            self.open_segment()
+        if type(body) == str:
+            body = body.encode()
+        header = make_header(flight_id, url, search_date, worker_num)
+        data = compress(body, self.compression)
+        offset = self.f.tell()
+        self.f.write(record_header.pack(b'PG', self.compression, len(header), len(data)))
+        self.f.write(header)
+        self.f.write(data)
+        self.f.flush()
+        length = self.f.tell()-offset
+        self.idx_f.write(index_entry.pack(int(flight_id), date_to_int(search_date), offset, length))
+        self.idx_f.flush()
+        self.record_num += 1
+        path = self.path
+
+        if self.f.tell() >= self.max_size or self.record_num >= self.max_records:
+            self.seal()
+        else:
+            self.seal_if_due()
+        return path,offset
+
+    def seal_if_due(self):
+        if self.f != None and self.max_age > 0 and time.time()-self.open_time >= self.max_age:
+            self.seal()
+
+    def seal(self):
+        """
+        Close the current segment and rename it to .seg so it can be read
+        by the ingestion.
+        """
+        if self.f == None:
+            return None
+        self.f.close()
+        self.idx_f.close()
+        self.f = None
+        self.idx_f = None
+        os.rename(self.path+'_', self.path)
+        return self.path
+
+    def close(self):
+        return self.seal()
+
+    def append_result_file(self, filename):
+        """
+        Append a result file written by Recorder, see read_result_file.
+        """
+        flight_id,url,search_date,worker_num,body = read_result_file(filename)
+        return self.append(flight_id, url, search_date, worker_num, body)
+
+def read_result_file(filename):
+    """
+    Split a result file written by Recorder into its header fields and body.
+    Return (flight_id, url, search_date, worker_num, body).
+    """
+    with open(filename,'rb') as f:
+        header = b''
+        for i in range(4):
+            header += f.readline()
+        body = f.read()
+    flight_id,url,search_date,worker_num = parse_header(header)
+    return flight_id,url,search_date,worker_num,body
+
+class SegmentReader():
+    """
+    Read the records of a segment file through a memory map, so a record
+    is read without reading the rest of the segment.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path,'rb')
+        try:
+            self.buf = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.buf = b''
+        if self.buf[0:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+            self.close()
+            raise ValueError("%s is not a segment file" %path)
+
+    def read_raw(self, offset):
+        """
+        Return the RawRecord at offset, None at the end of the segment or on
+        a truncated record. The data of the record is a memoryview of the
+        compressed body in the memory map, valid until close().
+        """
+        end = offset+record_header.size
+        if end > len(self.buf):
+            return None
+        magic,method,header_len,body_len = record_header.unpack_from(self.buf, offset)
+        if magic != b'PG' or end+header_len+body_len > len(self.buf):
+            return None
+        flight_id,url,search_date,worker_num = parse_header(self.buf[end:end+header_len])
+        length = record_header.size+header_len+body_len
+        data = memoryview(self.buf)[end+header_len:offset+length]
+        return RawRecord(flight_id,url,search_date,worker_num,offset,length,method,data)
+
+    def read_record(self, offset):
+        """
+        Return the Record at offset with its body decompressed, None at the
+        end of the segment or on a truncated record.
+        """
+        raw = self.read_raw(offset)
+        if raw == None:
+            return None
+        return Record(raw.flight_id,raw.url,raw.search_date,raw.worker_num,
+                      raw.offset,raw.length,decompress(raw.data,raw.method))
+
+    def iter_raw(self):
+        offset = len(SEGMENT_MAGIC)
+        while True:
+            raw = self.read_raw(offset)
+            if raw == None:
+                break
+            yield raw
+            offset += raw.length
+
+    def __iter__(self):
+        for raw in self.iter_raw():
+            yield Record(raw.flight_id,raw.url,raw.search_date,raw.worker_num,
+                         raw.offset,raw.length,decompress(raw.data,raw.method))
+
+    def close(self):
+        if type(self.buf) == mmap.mmap:
+            try:
+                self.buf.close()
+            except BufferError:
+                # A RawRecord still uses the map, it is closed with the last one
+                pass
+        self.f.close()
+
+def read_index(path):
+    """
+    Return the index entries of a segment as a list of tuples
+    (flight_id, search_date, offset, length).
+    """
+    with open(index_name(path),'rb') as f:
+        data = f.read()
+    n = len(data)//index_entry.size
+    return [index_entry.unpack_from(data, i*index_entry.size) for i in range(n)]
+
+INDEX_MAGIC = b'FIQSIDX1'
+INDEX_NAME = 'pages.idx'
+
+index_header = struct.Struct('>8sII')
+page_entry = struct.Struct('>iiIQI')
+
+def build_archive_index(dir_name='archive'):
+    """
+    Write the index of all sealed segments in dir_name into dir_name/pages.idx:
+        index header    struct '>8sII' : b'FIQSIDX1', segment number, names_len
+        names           names_len bytes, the segment names joined by '\n'
+        entries         struct '>iiIQI' : search_date as yyyymmdd, flight_id,
+                        segment number, offset, length
+    The entries are sorted by (search_date, flight_id) and, for the pages
+    of the same key, in the order of the segment names.
+    The file is replaced atomically. Return the list of segment names.
+    """
+    names = sorted([n for n in os.listdir(dir_name) if n.endswith('.seg')])
+    entry_list = []
+    for seg_no,name in enumerate(names):
+        for flight_id,search_date,offset,length in read_index(os.path.join(dir_name,name)):
+            entry_list.append((search_date,flight_id,seg_no,offset,length))
+    entry_list.sort()
+
+    blob = '\n'.join(names).encode()
+    path = os.path.join(dir_name, INDEX_NAME)
+    with open(path+'_','wb') as f:
+        f.write(index_header.pack(INDEX_MAGIC, len(names), len(blob)))
+        f.write(blob)
+        for entry in entry_list:
+            f.write(page_entry.pack(*entry))
+    os.replace(path+'_', path)
+    return names
+
+def newest_raw(raw_list, index=False):
+    """
+    Return the RawRecord of raw_list with the latest search_date time, the
+    last of them for the same time; its position in the list if index.
+    """
+    n = max(range(len(raw_list)), key=lambda i:(raw_list[i].search_date,i))
+    if index == True:
+        return n
+    return raw_list[n]
+
+class ArchiveReader():
+    """
+    Random access to the archived pages by (search_date, flight_id).
+    The index dir_name/pages.idx is memory mapped and searched by
+    bisection, a page is read from the memory map of its segment only.
+    The index is rebuilt when the segments in dir_name changed.
+    """
+    def __init__(self, dir_name='archive', update=True):
+        self.dir_name = dir_name
+        path = os.path.join(dir_name, INDEX_NAME)
+        names = sorted([n for n in os.listdir(dir_name) if n.endswith('.seg')])
+        if update == True and (not os.path.exists(path) or self.read_names(path) != names):
+            build_archive_index(dir_name)
+
+        self.f = open(path,'rb')
+        self.buf = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic,seg_num,names_len = index_header.unpack_from(self.buf, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError("%s is not an archive index" %path)
+        start = index_header.size
+        self.names = self.buf[start:start+names_len].decode().split('\n') if seg_num > 0 else []
+        self.entry_start = start+names_len
+        self.entry_num = (len(self.buf)-self.entry_start)//page_entry.size
+        self.segments = dict()
+
+    @staticmethod
+    def read_names(path):
+        with open(path,'rb') as f:
+            magic,seg_num,names_len = index_header.unpack(f.read(index_header.size))
+            if seg_num == 0:
+                return []
+            return f.read(names_len).decode().split('\n')
+
+    def entry(self, i):
+        return page_entry.unpack_from(self.buf, self.entry_start+i*page_entry.size)
+
+    def lower_bound(self, key):
+        """
+        Return the first entry number whose (search_date, flight_id) is not
+        less than key.
+        """
+        lo = 0
+        hi = self.entry_num
+        while lo < hi:
+            mid = (lo+hi)//2
+            if self.entry(mid)[0:2] < key:
+                lo = mid+1
+            else:
+                hi = mid
+        return lo
+
+    def segment(self, seg_no):
+        reader = self.segments.get(seg_no)
+        if reader == None:
+            reader = SegmentReader(os.path.join(self.dir_name, self.names[seg_no]))
+            self.segments[seg_no] = reader
+        return reader
+
+    def find_raw(self, flight_id, search_date):
+        """
+        Return the RawRecord list of the flight on that day, search_date is
+        'yyyy-mm-dd' or a datetime.date.
+        """
+        key = (date_to_int(str(search_date)), int(flight_id))
+        raw_list = []
+        i = self.lower_bound(key)
+        while i < self.entry_num:
+            d,fid,seg_no,offset,length = self.entry(i)
+            if (d,fid) != key:
+                break
+            raw = self.segment(seg_no).read_raw(offset)
+            if raw != None:
+                raw_list.append(raw)
+            i += 1
+        return raw_list
+
+    def get_page(self, flight_id, search_date):
+        """
+        Return the Record of the flight on that day with the body
+        decompressed, the newest one by the time in its header if the page
+        was fetched several times, or None.
+        """
+        raw_list = self.find_raw(flight_id, search_date)
+        if len(raw_list) == 0:
+            return None
+        raw = newest_raw(raw_list)
+        return Record(raw.flight_id,raw.url,raw.search_date,raw.worker_num,
+                      raw.offset,raw.length,decompress(raw.data,raw.method))
+
+    def day_entries(self, search_date):
+        """
+        Return the index entries of that day in flight_id order as a list
+        of tuples (flight_id, segment name, offset).
+        """
+        d = date_to_int(str(search_date))
+        entry_list = []
+        i = self.lower_bound((d,-2**31))
+        while i < self.entry_num:
+            entry_d,fid,seg_no,offset,length = self.entry(i)
+            if entry_d != d:
+                break
+            entry_list.append((fid,self.names[seg_no],offset))
+            i += 1
+        return entry_list
+
+    def last_day_entries(self, search_date):
+        """
+        Same as day_entries but only the newest page of every flight, the
+        one get_page returns. The segment names sort by prefix and process
+        id, not by time, so the headers of the pages of a flight fetched
+        several times are read to compare their time.
+        """
+        d = date_to_int(str(search_date))
+        entry_list = []
+        i = self.lower_bound((d,-2**31))
+        while i < self.entry_num:
+            entry_d,fid,seg_no,offset,length = self.entry(i)
+            if entry_d != d:
+                break
+            j = i+1
+            while j < self.entry_num and self.entry(j)[0:2] == (d,fid):
+                j += 1
+            if j-i == 1:
+                entry_list.append((fid,self.names[seg_no],offset))
+            else:
+                raw_list = []
+                for k in range(i,j):
+                    seg_no,offset = self.entry(k)[2:4]
+                    raw = self.segment(seg_no).read_raw(offset)
+                    if raw != None:
+                        raw_list.append((raw,self.names[seg_no]))
+                if len(raw_list) > 0:
+                    raw,name = raw_list[newest_raw([x[0] for x in raw_list], True)]
+                    entry_list.append((fid,name,raw.offset))
+            i = j
+        return entry_list
+
+    def iter_day(self, search_date):
+        """
+        Yield the RawRecord of every page of that day in flight_id order.
+        Nothing is copied: the data of a RawRecord is a memoryview of the
+        compressed body in the segment map, see page_text.
+        """
+        d = date_to_int(str(search_date))
+        i = self.lower_bound((d,-2**31))
+        while i < self.entry_num:
+            entry_d,fid,seg_no,offset,length = self.entry(i)
+            if entry_d != d:
+                break
+            raw = self.segment(seg_no).read_raw(offset)
+            if raw != None:
+                yield raw
+            i += 1
+
+    def close(self):
+        for reader in self.segments.values():
+            reader.close()
+        self.segments = dict()
+        try:
+            self.buf.close()
+        except BufferError:
+            pass
+        self.f.close()
+
+def page_text(raw):
+    """
+    Return the decompressed body of a RawRecord.
+    """
+    return decompress(raw.data, raw.method)
+
+def test():
+    import tempfile
+    d = tempfile.mkdtemp()
+    w = SegmentWriter(d, max_records=3)
+    page = "Result 1, $636.77\nDeparture\n10:05am - 9:35pm\nMultiple Airlines\n"*20
+    for i in range(7):
+        w.append(1000+i, "http://x/?id=%d" %i, "2016-06-02 10 05 33", 1, page)
+    w.close()
+    size = 0
+    for name in sorted(os.listdir(d)):
+        path = os.path.join(d,name)
+        size += os.path.getsize(path)
+        if name.endswith('.seg'):
+            records = list(SegmentReader(path))
+            print(name, [r.flight_id for r in records], read_index(path))
+            assert records[0].body.decode() == page
+    print("7 pages of %d bytes in %d bytes" %(len(page),size))
+
+    reader = ArchiveReader(d)
+    print(reader.get_page(1004, '2016-06-02')[0:6])
+    print([raw.flight_id for raw in reader.iter_day(datetime.date(2016,6,2))])
+    assert reader.get_page(1004, '2016-06-03') == None
+    reader.close()
+
+def main():
+    """
+    archive.py <flight_id> <yyyy-mm-dd> [dir] prints the archived page,
+    without arguments runs the test.
+    """
+    if len(sys.argv) < 3:
+        test()
+        return
+    dir_name = sys.argv[3] if len(sys.argv) > 3 else 'archive'
+    reader = ArchiveReader(dir_name)
+    record = reader.get_page(sys.argv[1], sys.argv[2])
+    if record == None:
+        print("flight id %s on %s is not archived" %(sys.argv[1],sys.argv[2]))
+    else:
+        print("<flight_id>%s\n<url>%s\n<search_date>%s\n<worker_num>%s"
+              %(record.flight_id,record.url,record.search_date,record.worker_num))
+        print(record.body.decode())
+    reader.close()
+
+if __name__=='__main__':
+    main()
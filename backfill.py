@@ -0,0 +1,204 @@
+#!/usr/local/bin/python3
+# Copyright (C) 2015-2025 Wang,Jing   <jingwangian@gmail.com>
+#
+# This file is part of Flight Inforation Query System (fiqs)
+#
+# fiqs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fiqs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fiqs.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Reparse the archived pages of a date range and replace their flight_price
+rows, e.g. after a fix of result.parse_block_info:
+
+    backfill.py <start yyyy-mm-dd> <end yyyy-mm-dd> [processes]
+
+The progress is saved into a checkpoint file after every committed batch,
+an interrupted backfill of the same range starts again after the last
+committed page.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import datetime
+import multiprocessing as mp
+
+import db
+import result
+import archive
+
+logger = logging.getLogger('[backfill]')
+
+g_archive_dir = 'archive'
+g_checkpoint_file = 'backfill.ckpt'
+
+# Pages replaced in one transaction
+g_batch_size = 500
+
+# Segment readers of a pool process, segment name -> SegmentReader
+segment_dict = dict()
+
+def reparse_page(entry):
+    """
+    Pool function: parse one archived page again.
+    entry is (flight_id, segment name, offset), return a tuple
+    (flight_id, search_date, flight_list, incomplete) or None if the page
+    can't be read or parsed, which fails this page only. The incomplete
+    blocks, without the times or the company, are left out of flight_list
+    and counted in incomplete.
+    """
+    flight_id,name,offset = entry
+    try:
+        reader = segment_dict.get(name)
+        if reader == None:
+            reader = archive.SegmentReader(os.path.join(g_archive_dir,name))
+            segment_dict[name] = reader
+        raw = reader.read_raw(offset)
+        if raw == None:
+            return None
+        search_date = raw.search_date.split(' ')[0]
+        flight_list = result.parse_page_body(archive.page_text(raw), raw.flight_id, search_date)
+        complete_list = [x for x in flight_list if db.is_complete_flight_info(x)]
+    except Exception as e:
+        logger.error("failed to reparse flight id %s in %s at %s: %s" %(flight_id,name,offset,e))
+        return None
+    return (raw.flight_id,search_date,complete_list,len(flight_list)-len(complete_list))
+
+def load_checkpoint(start_date, end_date):
+    """
+    Return (day, flight_id) of the last committed page of a backfill of the
+    same range, or None.
+    """
+    try:
+        with open(g_checkpoint_file) as f:
+            ckpt = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if ckpt.get('start') != str(start_date) or ckpt.get('end') != str(end_date):
+        return None
+    return ckpt['day'],ckpt['flight_id']
+
+def save_checkpoint(start_date, end_date, day, flight_id):
+    ckpt = {'start':str(start_date), 'end':str(end_date), 'day':str(day), 'flight_id':flight_id}
+    with open(g_checkpoint_file+'_','w') as f:
+        json.dump(ckpt, f)
+    os.replace(g_checkpoint_file+'_', g_checkpoint_file)
+
+class BackfillStats():
+    """
+    Progress of a backfill: pages, throughput and the parse yield, i.e.
+    the rows before (old) and after (new) the reparse, and the incomplete
+    blocks left out.
+    """
+    def __init__(self, total):
+        self.total = total
+        self.pages = 0
+        self.failed = 0
+        self.incomplete = 0
+        self.old_rows = 0
+        self.new_rows = 0
+        self.changed = 0
+        self.t1 = time.time()
+
+    def add(self, old, new):
+        self.pages += 1
+        self.old_rows += old
+        self.new_rows += new
+        if old != new:
+            self.changed += 1
+
+    def report(self, day):
+        seconds = time.time()-self.t1
+        rate = self.pages/seconds if seconds > 0 else 0
+        msg = ("%s %d/%d pages, %.1f pages/s, rows %d -> %d (%+d), %d pages changed yield, %d failed, %d incomplete blocks"
+               %(day,self.pages,self.total,rate,self.old_rows,self.new_rows,
+                 self.new_rows-self.old_rows,self.changed,self.failed,self.incomplete))
+        logger.info(msg)
+        print(msg)
+
+def backfill(start_date, end_date, processes=mp.cpu_count(), batch_size=None):
+    """
+    Reparse the archived pages with search_date from start_date to end_date
+    (both included) with a pool of processes and replace the rows of every
+    (flight_id, search_date) atomically. Return the BackfillStats.
+    """
+    if batch_size == None:
+        batch_size = g_batch_size
+
+    reader = archive.ArchiveReader(g_archive_dir)
+    day_list = []
+    day = start_date
+    while day <= end_date:
+        day_list.append((day,reader.last_day_entries(day)))
+        day += datetime.timedelta(1)
+    reader.close()
+
+    ckpt = load_checkpoint(start_date, end_date)
+    if ckpt != None:
+        print("resume after flight id %d of %s" %(ckpt[1],ckpt[0]))
+        day_list = [(day,[e for e in entry_list if (str(day),e[0]) > tuple(ckpt)])
+                    for day,entry_list in day_list if str(day) >= ckpt[0]]
+
+    stats = BackfillStats(sum([len(entry_list) for day,entry_list in day_list]))
+    pool = mp.Pool(processes)
+    fdb = db.FlightPlanDatabase()
+    fdb.connectDB()
+    try:
+        for day,entry_list in day_list:
+            for i in range(0, len(entry_list), batch_size):
+                batch = entry_list[i:i+batch_size]
+                page_list = []
+                for page in pool.imap(reparse_page, batch, chunksize=16):
+                    if page == None:
+                        stats.failed += 1
+                    else:
+                        page_list.append(page[:3])
+                        stats.incomplete += page[3]
+                deleted_dict = fdb.replace_flight_price_rows(page_list)
+                for flight_id,search_date,flight_list in page_list:
+                    stats.add(deleted_dict[(int(flight_id),search_date)], len(flight_list))
+                save_checkpoint(start_date, end_date, day, batch[-1][0])
+                stats.report(day)
+        if os.path.exists(g_checkpoint_file):
+            os.remove(g_checkpoint_file)
+    finally:
+        pool.close()
+        pool.join()
+        fdb.disconnectDB()
+
+    return stats
+
+def init_log():
+    d = str(datetime.date.today())
+    logger_handle=logging.FileHandler('log/backfill_'+d+'.log')
+    formatter = logging.Formatter('%(levelname)s: %(asctime)s - %(name)-8s %(message)s')
+    logger_handle.setFormatter(formatter)
+    logger.addHandler(logger_handle)
+    logger.setLevel('INFO')
+
+def main():
+    if len(sys.argv) < 3:
+        print(__doc__)
+        return
+    start_date = datetime.datetime.strptime(sys.argv[1],'%Y-%m-%d').date()
+    end_date = datetime.datetime.strptime(sys.argv[2],'%Y-%m-%d').date()
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else mp.cpu_count()
+
+    init_log()
+    stats = backfill(start_date, end_date, processes)
+    stats.report("%s - %s" %(start_date,end_date))
+
+if __name__=='__main__':
+    main()
@@ -17,16 +17,76 @@
 # along with fiqs.  If not, see <http://www.gnu.org/licenses/>.
 
 import psycopg2
+import psycopg2.extras
+import time
 import datetime
 import url
 import logging
 
 main_logger = None
 
+# pg_advisory_xact_lock key taken by add_one_group_flight_schedule, so two
+# hosts starting together don't both add the same missing flights
+schedule_lock_key = 0x66697173
+
 class DBError(Exception):
     def __init__(self,reason="unknown"):
         self.reason = reason
     
+class StatusWriter():
+    """
+    Coalesce the status updates of flight_price_query_task in memory and
+    write them with one multi-row UPDATE ... FROM (VALUES ...) and one
+    commit when max_size updates are pending or the oldest one waited
+    max_delay seconds.
+    Only the last status of a (flight_id, execute_date) is written. A
+    status 1 (running) never overwrites a status 2 (finished) written by
+    another process in the meantime.
+    """
+    def __init__(self, fdb, max_size=200, max_delay=5):
+        self.fdb = fdb
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.pending = dict()
+        self.first_time = None
+
+    def update(self, flight_id, status, search_date):
+        if flight_id == None:
+            return
+        if len(self.pending) == 0:
+            self.first_time = time.time()
+        self.pending[(int(flight_id),str(search_date))] = status
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        if len(self.pending) > 0 and time.time()-self.first_time >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return 0
+        values = [(k[0],status,k[1]) for k,status in self.pending.items()]
+        cur = self.fdb.conn.cursor()
+        try:
+            psycopg2.extras.execute_values(cur,
+                        '''UPDATE flight_price_query_task t SET status = v.status
+                           FROM (VALUES %s) AS v(flight_id,status,execute_date)
+                           WHERE t.flight_id = v.flight_id
+                             AND t.execute_date = v.execute_date
+                             AND NOT (v.status = 1 AND t.status = 2)''',
+                        values, template='(%s::int4,%s::int4,%s::date)', page_size=1000)
+            self.fdb.conn.commit()
+        except:
+            self.fdb.conn.rollback()
+            raise
+        finally:
+            cur.close()
+        self.pending = dict()
+        return len(values)
+
 class FlightPlanDatabase():
     def __init__(self,database='flight_db',user='wangj', host='localhost', port=5432):
         self.database=database
@@ -35,6 +95,8 @@ class FlightPlanDatabase():
         self.port=port
         self.conn=None
         self.connected = False
+        self.status_writer = StatusWriter(self)
+        self.company_dict = dict()   #airline company name -> id
         
     def __del__(self):
         if self.connected==True:
@@ -49,8 +111,60 @@ class FlightPlanDatabase():
             self.connected = True
         except psycopg2.OperationalError:
             raise DBError("Failed to connetc to DB")
+        
+        self.load_company_dict()
+    
+    def load_company_dict(self):
+        """
+        Warm the airline company cache with the whole airline_company table
+        """
+        cur = self.conn.cursor()
+        try:
+            cur.execute('''SELECT id,name FROM airline_company''')
+            self.company_dict = dict()
+            for col in cur.fetchall():
+                self.company_dict[col[1]] = col[0]
+            self.conn.commit()
+        finally:
+            cur.close()
+    
+    def get_company_id_dict(self, name_list):
+        """
+        Return a dict name -> airline company id for all names in name_list.
+        The names not in the cache are added into airline_company and read
+        back with one statement each for the whole list, and committed at
+        once so the cache never holds an id of a rolled back row. The
+        unique name constraint makes concurrent processes share one row
+        per company.
+        """
+        unknown = [name for name in set(name_list) if name not in self.company_dict]
+        if len(unknown) > 0:
+            cur = self.conn.cursor()
+            try:
+                cur.execute('''INSERT INTO airline_company (id,name)
+                               SELECT nextval('airline_company_id'),n FROM unnest(%s::varchar[]) AS n
+                               ON CONFLICT (name) DO NOTHING''',(unknown,))
+                cur.execute('''SELECT id,name FROM airline_company WHERE name = ANY(%s)''',(unknown,))
+                rows = cur.fetchall()
+                self.conn.commit()
+            except:
+                self.conn.rollback()
+                raise
+            finally:
+                cur.close()
+            for col in rows:
+                self.company_dict[col[1]] = col[0]
+        
+        company_dict = dict()
+        for name in name_list:
+            company_dict[name] = self.company_dict[name]
+        return company_dict
             
     def disconnectDB(self):
+        try:
+            self.status_writer.flush()
+        except Exception as e:
+            print('db error in flush status: %s' %e)
         try:
             self.conn.close()
         except:
@@ -180,11 +294,72 @@ class FlightPlanDatabase():
 
     def get_flight_url_by_id(self, id):
         req_url = None
+        
+        task_dict = self.get_flight_url_by_ids([id])
+        if id in task_dict:
+            req_url = task_dict[id]['url']
+        
+        return req_url
 
+    def get_flight_url_by_ids(self, id_list):
+        """
+        Get the request url and the flight attributes of all flights in
+        id_list with one query.
+        Return a dict flight_id -> task, every task is a dict:
+            task['url'] the request url
+            task['flight'] the flight dict used to create the url
+        """
+        task_dict = dict()
+        if len(id_list) == 0:
+            return task_dict
+
+        url_creater=url.ExpediaReqURL()
         cur = self.conn.cursor()
         
         try:
             cur.execute('''select id,
+                        flight_url_view.from,
+                        flight_url_view.to,
+                        trip,
+                        start_date,
+                        stay_days,
+                        adults,
+                        children,
+                        age,
+                        class,
+                        request_url
+                        from flight_url_view where id = ANY(%s)''', (list(id_list),))
+            
+            for tup in cur.fetchall():
+                flight = flight_url_row_to_dict(tup)
+                
+                task = dict()
+                task['url'] = tup[10]
+                task['flight'] = flight
+                task_dict[flight['id']] = task
+            
+            # Flights created before the request_url column was filled
+            missing = [task for task in task_dict.values() if task['url'] == None]
+            url_list = url_creater.createURLList([task['flight'] for task in missing])
+            for task,req_url in zip(missing,url_list):
+                task['url'] = req_url
+        finally:
+            cur.close()
+        
+        return task_dict
+
+    def fill_request_urls(self, only_missing=True):
+        """
+        Create the request url of the flights not departed yet in one
+        call of ExpediaReqURL.createURLList and store them with one
+        UPDATE. With only_missing only the flights without request_url
+        are filled, which are the new flights and the ones reset by the
+        city/cabinclass triggers.
+        Return the number of urls filled.
+        """
+        cur = self.conn.cursor()
+        try:
+            sql_cmd = '''select id,
                         flight_url_view.from,
                         flight_url_view.to,
                         trip,
@@ -194,68 +369,260 @@ class FlightPlanDatabase():
                         children,
                         age,
                         class 
-                        from flight_url_view where id=%s''', (id,))
+                        from flight_url_view where start_date>current_date'''
+            if only_missing == True:
+                sql_cmd += ' and request_url is null'
+            cur.execute(sql_cmd)
             
-            tup = cur.fetchone()
-            flight={}
-            flight['id']=tup[0]
-            flight['from'] = tup[1]
-            flight['to'] = tup[2]
-            flight['trip'] = tup[3]
-            flight['start_date'] = tup[4]
-            flight['return_date'] = tup[4]
-            flight['stay_days'] = tup[5]
-            flight['adults'] = tup[6]
-            flight['children'] = tup[7]
-            flight['children_age'] = tup[8]
-            flight['cabinclass'] = tup[9]
+            flight_list = [flight_url_row_to_dict(tup) for tup in cur.fetchall()]
+            if len(flight_list) == 0:
+                return 0
             
-            url_creater=url.ExpediaReqURL()
-            req_url = url_creater.createURL(**flight)
+            url_list = url.ExpediaReqURL().createURLList(flight_list)
+            values = [(flight['id'],req_url) for flight,req_url in zip(flight_list,url_list)]
+            psycopg2.extras.execute_values(cur,
+                        '''UPDATE flight SET request_url = v.url
+                           FROM (VALUES %s) AS v(id,url)
+                           WHERE flight.id = v.id''',
+                        values, page_size=1000)
+            self.conn.commit()
         finally:
             cur.close()
         
-        return req_url
+        return len(values)
 
     def add_into_flight_price_tbl(self, flight_info):
         """
         Insert one result for flight price into flight_price table
+        Return True if the row has been inserted.
         """
         cur = self.conn.cursor()
+        ret = False
         
-#         print('company --- %s' %flight_info['company'])
         try:
-        
-            cur.execute('''SELECT * FROM get_airline_company_id_by_name(%s)''',(flight_info['company'],))
-            
-            
-            company_tuple=cur.fetchone()
-            company_id=company_tuple[0]
+            company_id = self.get_company_id_dict([flight_info['company']])[flight_info['company']]
             
             cur.execute('''INSERT INTO flight_price 
                            (flight_id,price,company_id,departure_time,arrival_time,duration,span_days,stop,stop_info,search_date)
-                            VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s);''',
-                            (flight_info['id'],
-                             flight_info['price'],
-                             company_id,
-                             flight_info['dep_time'],
-                             flight_info['arr_time'],
-                             flight_info['duration'],
-                             flight_info['span_days'],
-                             flight_info['stop'],
-                             flight_info['stop_info'],
-                             flight_info['search_date']))
+                            VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) '''+flight_price_conflict_sql,
+                            flight_price_row(flight_info, company_id))
             
             self.conn.commit()
+            ret = True
         except Exception as e:
+            self.conn.rollback()
             print('db error in add_into_flight_price_tbl: %s' %e)
                 
         finally:
             cur.close()
+        
+        return ret
+            
+    def add_flight_list_into_flight_price_tbl(self, flight_list, page_hash=None, source=None):
+        """
+        Upsert all results in flight_list into flight_price table with
+        multi-row INSERTs in one transaction. If the batch fails it is
+        inserted again row by row, so only the failing rows are lost.
+        page_hash: the page the results come from. It is recorded in
+        ingest_manifest in the same transaction and a page already there
+        is skipped, so a page ingested again after a crash adds nothing.
+        source: the result file or segment name kept in the manifest.
+        The incomplete results, without the times or the company, are left
+        out as they can't make a flight_price row.
+        Return the number of rows inserted or updated.
+        """
+        flight_list = [x for x in flight_list if is_complete_flight_info(x)]
+        if len(flight_list) == 0:
+            return 0
+        
+        cur = self.conn.cursor()
+        try:
+            # get_company_id_dict commits the new companies, it must run
+            # before the manifest row is in the transaction
+            company_dict = self.get_company_id_dict([flight_info['company'] for flight_info in flight_list])
+            
+            if page_hash != None:
+                cur.execute('''INSERT INTO ingest_manifest (page_hash,source,flight_id,search_date,row_num)
+                               VALUES(%s,%s,%s,%s,%s)
+                               ON CONFLICT (page_hash) DO NOTHING RETURNING page_hash''',
+                            (psycopg2.Binary(page_hash),source,flight_list[0]['id'],
+                             flight_list[0]['search_date'],len(flight_list)))
+                if cur.fetchone() == None:
+                    self.conn.rollback()
+                    return 0
+            
+            rows = dedup_flight_price_rows([flight_price_row(flight_info, company_dict[flight_info['company']])
+                                            for flight_info in flight_list])
+            psycopg2.extras.execute_values(cur,
+                        '''INSERT INTO flight_price 
+                           (flight_id,price,company_id,departure_time,arrival_time,duration,span_days,stop,stop_info,search_date)
+                           VALUES %s '''+flight_price_conflict_sql,
+                        rows, page_size=1000)
+            self.conn.commit()
+            return len(rows)
+        except Exception as e:
+            self.conn.rollback()
+            print('db error in add_flight_list_into_flight_price_tbl: %s, insert row by row' %e)
+        finally:
+            cur.close()
+        
+        # The page is not recorded in ingest_manifest, ingesting it again
+        # only updates the same rows
+        row_num = 0
+        for flight_info in flight_list:
+            if self.add_into_flight_price_tbl(flight_info) == True:
+                row_num += 1
+        return row_num
             
+    def replace_flight_price_rows(self, page_list):
+        """
+        Replace the flight_price rows of every (flight_id, search_date) in
+        page_list by the rows of its new flight_list, with one DELETE and
+        one INSERT in a single transaction, so a reader sees either the old
+        or the new rows of a page.
+        page_list: a list of tuples (flight_id, search_date, flight_list).
+        The incomplete flight_info dicts are left out, see
+        is_complete_flight_info.
+        Return a dict (flight_id, search_date) -> number of deleted rows.
+        """
+        if len(page_list) == 0:
+            return dict()
+        
+        keys = [(int(flight_id),str(search_date)) for flight_id,search_date,flight_list in page_list]
+        cur = self.conn.cursor()
+        try:
+            info_list = [flight_info for x in page_list for flight_info in x[2]
+                         if is_complete_flight_info(flight_info)]
+            company_dict = self.get_company_id_dict([flight_info['company'] for flight_info in info_list])
+            
+            deleted = psycopg2.extras.execute_values(cur,
+                        '''DELETE FROM flight_price p USING (VALUES %s) AS v(flight_id,search_date)
+                           WHERE p.flight_id = v.flight_id AND p.search_date = v.search_date
+                           RETURNING p.flight_id, p.search_date''',
+                        keys, template='(%s::int4,%s::date)', page_size=1000, fetch=True)
+            
+            rows = dedup_flight_price_rows([flight_price_row(flight_info, company_dict[flight_info['company']])
+                                            for flight_info in info_list])
+            if len(rows) > 0:
+                psycopg2.extras.execute_values(cur,
+                        '''INSERT INTO flight_price 
+                           (flight_id,price,company_id,departure_time,arrival_time,duration,span_days,stop,stop_info,search_date)
+                           VALUES %s '''+flight_price_conflict_sql,
+                        rows, page_size=1000)
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+        
+        deleted_dict = dict()
+        for key in keys:
+            deleted_dict[key] = 0
+        for col in deleted:
+            key = (col[0],str(col[1]))
+            deleted_dict[key] = deleted_dict.get(key,0)+1
+        return deleted_dict
+            
+    def manage_flight_price_partitions(self, ahead_months=2, keep_months=0):
+        """
+        Create the flight_price partitions from this month to ahead_months
+        later. If keep_months is more than 0 the partitions older than
+        keep_months before this month are detached into flight_archive.
+        Return the list of the detached partition names.
+        """
+        detached = []
+        cur = self.conn.cursor()
+        try:
+            cur.execute('''SELECT create_flight_price_partitions(current_date,
+                               (current_date + %s * interval '1 month')::date)''',(ahead_months,))
+            if keep_months > 0:
+                cur.execute('''SELECT * FROM detach_flight_price_partitions(
+                               (date_trunc('month', current_date) - %s * interval '1 month')::date)''',(keep_months,))
+                detached = [col[0] for col in cur.fetchall()]
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+        
+        return detached
+    
+    def check_page_fingerprint(self, flight_id, fingerprint, search_date):
+        """
+        Return the date the stored fares of flight_id have been the same
+        since if fingerprint is the one of the last page stored, and
+        record that the page was seen on search_date; None otherwise.
+        """
+        cur = self.conn.cursor()
+        try:
+            cur.execute('''UPDATE flight_page_fingerprint SET last_seen = greatest(last_seen, %s)
+                           WHERE flight_id = %s AND fingerprint = %s
+                           RETURNING unchanged_since''',
+                        (search_date,flight_id,psycopg2.Binary(fingerprint)))
+            col = cur.fetchone()
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+        
+        if col == None:
+            return None
+        return col[0]
+    
+    def update_page_fingerprint(self, flight_id, fingerprint, search_date):
+        """
+        Store the fingerprint of the page of flight_id crawled on
+        search_date, called once its fares are committed. The date of
+        unchanged_since moves on only if the page changed; a page older
+        than the last one seen is ignored.
+        """
+        cur = self.conn.cursor()
+        try:
+            cur.execute('''INSERT INTO flight_page_fingerprint AS f (flight_id,fingerprint,unchanged_since,last_seen)
+                           VALUES(%s,%s,%s,%s)
+                           ON CONFLICT (flight_id) DO UPDATE SET
+                               unchanged_since = CASE WHEN f.fingerprint = EXCLUDED.fingerprint
+                                                      THEN f.unchanged_since
+                                                      ELSE EXCLUDED.unchanged_since END,
+                               fingerprint = EXCLUDED.fingerprint,
+                               last_seen = EXCLUDED.last_seen
+                           WHERE f.last_seen <= EXCLUDED.last_seen''',
+                        (flight_id,psycopg2.Binary(fingerprint),search_date,search_date))
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+    
+    def prune_ingest_manifest(self, keep_days=30):
+        """
+        Delete the ingest_manifest rows of the pages searched more than
+        keep_days days ago, they are not in the results directory any more.
+        Return the number of deleted rows.
+        """
+        cur = self.conn.cursor()
+        try:
+            cur.execute('''DELETE FROM ingest_manifest WHERE search_date < current_date - %s''',(keep_days,))
+            num = cur.rowcount
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+        
+        return num
+    
     def create_today_task(self):
         """
         Create today's task by select flight_id into flight_price_query_task.
+        The primary key (flight_id, execute_date) lets several hosts call it
+        at the same time, the later insert waits and adds nothing.
         """
         total_task_num = 0
 
@@ -266,7 +633,8 @@ class FlightPlanDatabase():
             col = cur.fetchone()
             num = col[0]
             if num<1:
-                cur.execute('''insert into flight_price_query_task select id,0,current_date from flight where start_date>current_date;''')
+                cur.execute('''insert into flight_price_query_task select id,0,current_date from flight where start_date>current_date
+                               on conflict (flight_id,execute_date) do nothing;''')
                 self.conn.commit()
                 cur.execute('''SELECT count(*) from flight_price_query_task where execute_date=current_date;''')
                 col = cur.fetchone()
@@ -275,6 +643,28 @@ class FlightPlanDatabase():
             cur.close()
             return total_task_num            
     
+    def score_today_tasks(self, w_departure=1.0, w_volatility=1.0, w_stale=0.5,
+                          window_days=14, skip_score=0.3, max_skip_days=3):
+        """
+        Set the priority of today's tasks not started yet and skip the low
+        value ones with the score_query_tasks function, see functions.sql.
+        A skip_score of 0 skips no task.
+        Return a tuple (scored task number, skipped task number).
+        """
+        cur = self.conn.cursor()
+        try:
+            cur.execute('''SELECT * FROM score_query_tasks(%s,%s,%s,%s,%s,%s)''',
+                        (w_departure,w_volatility,w_stale,window_days,skip_score,max_skip_days))
+            col = cur.fetchone()
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+        
+        return col[0],col[1]
+    
     def get_one_task_id(self):
         """
         Get one flight_id from flight_price_query_task where execute_date is
@@ -285,7 +675,7 @@ class FlightPlanDatabase():
         cur = self.conn.cursor()
         cur.execute('''Select flight_id from flight_price_query_task 
                         where execute_date=current_date and status = 0 
-                        order by flight_id limit 1''')
+                        order by priority desc nulls last, flight_id limit 1''')
 
         col = cur.fetchone()
         
@@ -299,13 +689,13 @@ class FlightPlanDatabase():
     def get_today_task_id(self,limit_number=1000):
         """
         Get all flight_id from flight_price_query_task where execute_date is
-        current_date.
+        current_date, the highest priority first.
         Return a task_list include all flight_id.
         """
         cur = self.conn.cursor()
         cur.execute('''Select flight_id from flight_price_query_task 
-                        where execute_date=current_date and status <> 2 
-                        order by flight_id limit %s;''',(limit_number,))
+                        where execute_date=current_date and status in (0,1) 
+                        order by priority desc nulls last, flight_id limit %s;''',(limit_number,))
 
         task_list=[]
         
@@ -320,6 +710,64 @@ class FlightPlanDatabase():
         
         return task_list
     
+    def claim_tasks(self, node_id, worker_id, batch_size=5, lease_seconds=600):
+        """
+        Claim up to batch_size of today's tasks for the worker_id on node_id,
+        the highest priority first.
+        The claimed tasks are set to status 1 with a lease; a task which is
+        still status 1 when its lease expired can be claimed again. A task
+        at status 1 without a lease is not: it is run by a queue-mode host,
+        or its page is crawled and waits for the ingestion, see
+        end_task_leases.
+        Rows locked by other claimers are skipped, so any number of
+        processes on any number of hosts can claim at the same time
+        without getting the same task.
+        Return a task_list include the claimed flight_id.
+        """
+        cur = self.conn.cursor()
+        try:
+            cur.execute('''UPDATE flight_price_query_task t
+                           SET status=1, node_id=%s, worker_id=%s,
+                               lease_expire=now()+%s*interval '1 second'
+                           FROM (SELECT flight_id,execute_date FROM flight_price_query_task
+                                 WHERE execute_date=current_date
+                                   AND (status=0 OR (status=1 AND lease_expire<now()))
+                                 ORDER BY priority DESC NULLS LAST, flight_id
+                                 LIMIT %s
+                                 FOR UPDATE SKIP LOCKED) c
+                           WHERE t.flight_id=c.flight_id AND t.execute_date=c.execute_date
+                           RETURNING t.flight_id;''',
+                        (node_id,worker_id,lease_seconds,batch_size))
+            task_list = [col[0] for col in cur.fetchall()]
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+        
+        return sorted(task_list)
+    
+    def end_task_leases(self, task_list, search_date):
+        """
+        Clear the lease of the claimed tasks in task_list whose page has
+        been crawled, so they are not claimed again while their page waits
+        for the ingestion, which sets the final status.
+        """
+        if len(task_list) == 0:
+            return
+        cur = self.conn.cursor()
+        try:
+            cur.execute('''UPDATE flight_price_query_task SET lease_expire=NULL
+                           WHERE flight_id = ANY(%s) AND execute_date=%s''',
+                        (list(task_list),search_date))
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+    
     def update_status_in_flight_price_query_task_tbl(self, flight_id, status, search_date):
         """
         update the flight_price_query_task table, set the status to 1 
@@ -333,25 +781,153 @@ class FlightPlanDatabase():
         self.conn.commit()
         cur.close()
         
-    def add_one_group_flight_schedule(self,start_date,start_date_range):
+    def queue_status_in_flight_price_query_task_tbl(self, flight_id, status, search_date):
+        """
+        Same as update_status_in_flight_price_query_task_tbl but the update
+        is written later in a batch by the status_writer. Pending updates
+        are flushed at the latest by disconnectDB.
+        """
+        self.status_writer.update(flight_id, status, search_date)
+    
+    def flush_status_in_flight_price_query_task_tbl(self, force=True):
+        """
+        Write the pending status updates, only the due ones if not force.
+        """
+        if force == True:
+            self.status_writer.flush()
+        else:
+            self.status_writer.flush_if_due()
+        
+    def add_one_group_flight_schedule(self,start_date,start_date_range,stay_days_range=0,prune=True):
         """
         This function add a group fligth schedule which start_date will be in 
-        a list of start_date_list
+        [start_date, start_date+start_date_range).
+        Only the missing (airline, start_date, trip, stay_days) flights are
+        added, with one INSERT of generate_series x airline, so a rolling
+        window only adds its new last day.
+        stay_days_range: 0 for oneway flights, otherwise roundtrip flights
+        with stay_days from 1 to stay_days_range are added.
+        prune: in the same transaction delete the departed flights which
+        have never got a price, the ones with prices are kept for history.
+        The transaction holds an advisory lock, the check of the missing
+        flights of another host waits for the flights this one adds.
+        Return the number of flights added.
         """
+        if stay_days_range > 0:
+            trip = 2    #roundtrip
+            stay_min = 1
+            stay_max = stay_days_range
+        else:
+            trip = 1    #oneway
+            stay_min = 0
+            stay_max = 0
+        end_date = start_date+datetime.timedelta(start_date_range-1)
         
         cur = self.conn.cursor()
-        for i in range(0,start_date_range):
-            sd_date = start_date+datetime.timedelta(i)
-            sd_str = sd_date.strftime("%Y-%m-%d")
-            cur.execute('''select count(*) from flight where start_date=%s''',(sd_str,))
-            col = cur.fetchone()
-            num = int(col[0])
-            if num > 0:
-                continue
-            cur.execute('''select create_one_way_airlines(%s)''',(sd_str,))
+        try:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (schedule_lock_key,))
+            if prune == True:
+                cur.execute('''DELETE FROM flight f
+                               WHERE f.start_date<=current_date
+                                 AND NOT EXISTS (SELECT 1 FROM flight_price p WHERE p.flight_id=f.id)''')
+            
+            cur.execute('''INSERT INTO flight
+                           (id,airline_id,trip,start_date,stay_days,adults,children,children_age,cabinclass,create_date)
+                           SELECT nextval('flight_id'), n.*
+                           FROM (SELECT a.id, %(trip)s, d.start_date, s.stay_days,
+                                        1, 0, '{}'::int2[], 3, current_date
+                                 FROM (SELECT day::date AS start_date
+                                       FROM generate_series(%(start)s::date, %(end)s::date, interval '1 day') AS day) AS d
+                                 CROSS JOIN airline a
+                                 CROSS JOIN generate_series(%(stay_min)s, %(stay_max)s) AS s(stay_days)
+                                 WHERE NOT EXISTS (SELECT 1 FROM flight f
+                                                   WHERE f.airline_id=a.id
+                                                     AND f.start_date=d.start_date
+                                                     AND f.trip=%(trip)s
+                                                     AND f.stay_days=s.stay_days)
+                                 ORDER BY d.start_date, a.id, s.stay_days) AS n''',
+                        {'trip':trip, 'start':start_date, 'end':end_date,
+                         'stay_min':stay_min, 'stay_max':stay_max})
+            num = cur.rowcount
             self.conn.commit()
-        cur.close()
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
         
+        return num
+        
+# Upsert on the flight_price_natural_key constraint, a fare stored again
+# keeps one row with the last price
+flight_price_conflict_sql = '''ON CONFLICT (flight_id,search_date,company_id,departure_time,arrival_time,span_days,stop,stop_info)
+                           DO UPDATE SET price = EXCLUDED.price, duration = EXCLUDED.duration'''
+
+def dedup_flight_price_rows(rows):
+    """
+    Keep the first of the flight_price_row tuples with the same natural
+    key, one upsert statement can't update the same row twice.
+    """
+    key_set = set()
+    new_rows = []
+    for row in rows:
+        key = (str(row[0]),str(row[9]),row[2],row[3],row[4],row[6],row[7],row[8])
+        if key not in key_set:
+            key_set.add(key)
+            new_rows.append(row)
+    return new_rows
+
+def is_complete_flight_info(flight_info):
+    """
+    Return True if the flight_info has all the values of a flight_price
+    row. parse_block_info returns only the price of a Result block
+    without a time line.
+    """
+    for k in ('company','dep_time','arr_time','duration','span_days','stop','stop_info'):
+        if k not in flight_info:
+            return False
+    return True
+
+def flight_price_row(flight_info, company_id):
+    """
+    Return the values of a flight_info in the order of the flight_price
+    columns flight_id, price, company_id, departure_time, arrival_time,
+    duration, span_days, stop, stop_info, search_date.
+    """
+    return (flight_info['id'],
+            flight_info['price'],
+            company_id,
+            flight_info['dep_time'],
+            flight_info['arr_time'],
+            flight_info['duration'],
+            flight_info['span_days'],
+            flight_info['stop'],
+            flight_info['stop_info'],
+            flight_info['search_date'])
+
+def flight_url_row_to_dict(tup):
+    """
+    Convert a flight_url_view row selected as id, from, to, trip,
+    start_date, stay_days, adults, children, age, class into the flight
+    dict used by ExpediaReqURL.
+    """
+    flight={}
+    flight['id']=tup[0]
+    flight['from'] = tup[1]
+    flight['to'] = tup[2]
+    flight['trip'] = tup[3]
+    flight['start_date'] = tup[4]
+    flight['stay_days'] = tup[5]
+    if tup[5] != None:
+        flight['return_date'] = tup[4]+datetime.timedelta(tup[5])
+    else:
+        flight['return_date'] = tup[4]
+    flight['adults'] = tup[6]
+    flight['children'] = tup[7]
+    flight['children_age'] = tup[8]
+    flight['cabinclass'] = tup[9]
+    return flight
+
 def test():
     fdb = FlightPlanDatabase()
   
@@ -386,7 +962,55 @@ def test_add_flight_schedule():
     except DBError as err:
         print("Error: %s" % str(err))    
 
-def create_today_flight_schedule():
+def claim_tasks_exec(node_id, worker_id, claim_q):
+    fdb = FlightPlanDatabase()
+    fdb.connectDB()
+    try:
+        while True:
+            task_list = fdb.claim_tasks(node_id, worker_id, 5, 60)
+            if len(task_list) == 0:
+                break
+            for flight_id in task_list:
+                claim_q.put(flight_id)
+    finally:
+        fdb.disconnectDB()
+        claim_q.put(None)
+
+def test_claim_tasks(process_num=4):
+    """
+    Let process_num processes claim today's tasks at the same time and
+    check no task is claimed twice.
+    Note: the claimed tasks are left with status 1.
+    """
+    import multiprocessing as mp
+    
+    claim_q = mp.Queue()
+    p_list = []
+    for i in range(process_num):
+        p = mp.Process(target=claim_tasks_exec, args=('test',i+1,claim_q))
+        p.start()
+        p_list.append(p)
+    
+    claimed = []
+    done_num = 0
+    while done_num < process_num:
+        flight_id = claim_q.get()
+        if flight_id == None:
+            done_num += 1
+        else:
+            claimed.append(flight_id)
+    
+    for p in p_list:
+        p.join()
+    
+    print("claimed %d tasks, %d unique" %(len(claimed),len(set(claimed))))
+
+def create_today_flight_schedule(roundtrip_stay_days=0):
+    """
+    Keep the flight schedule of the next 180 days and create today's task.
+    roundtrip_stay_days: also keep roundtrip flights with stay days from 1
+    to this value when it is more than 0.
+    """
     fdb = FlightPlanDatabase()
     try:
         fdb.connectDB()
@@ -394,7 +1018,14 @@ def create_today_flight_schedule():
         start_date=datetime.date.today()+datetime.timedelta(1)
         start_date_range=180   #Create 180 days data
         
-        fdb.add_one_group_flight_schedule(start_date,start_date_range)
+        t1 = datetime.datetime.now()
+        num = fdb.add_one_group_flight_schedule(start_date,start_date_range)
+        if roundtrip_stay_days > 0:
+            num += fdb.add_one_group_flight_schedule(start_date,start_date_range,roundtrip_stay_days,False)
+        t2 = datetime.datetime.now()
+        print("Added %d flights in %s" %(num,t2-t1))
+        
+        fdb.fill_request_urls()
         
         fdb.create_today_task()
 
@@ -0,0 +1,203 @@
+#!/usr/local/bin/python3
+# Copyright (C) 2015-2025 Wang,Jing   <jingwangian@gmail.com>
+#
+# This file is part of Flight Inforation Query System (fiqs)
+#
+# fiqs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fiqs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fiqs.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import logging
+import threading
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+pool_logger = logging.getLogger('[Worker]')
+
+def get_process_tree_rss(pid):
+    """
+    Return the RSS in bytes of the process and all its children.
+    The driver process is geckodriver, the browser runs as its child.
+    """
+    if psutil != None:
+        try:
+            p = psutil.Process(pid)
+            rss = p.memory_info().rss
+            for c in p.children(recursive=True):
+                try:
+                    rss += c.memory_info().rss
+                except psutil.NoSuchProcess:
+                    pass
+            return rss
+        except psutil.NoSuchProcess:
+            return 0
+
+    rss = 0
+    pid_list = [pid]
+    while len(pid_list) > 0:
+        p = pid_list.pop()
+        try:
+            with open('/proc/%d/status' %p) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1])*1024
+                        break
+            with open('/proc/%d/task/%d/children' %(p,p)) as f:
+                pid_list.extend([int(x) for x in f.read().split()])
+        except (OSError, ValueError):
+            pass
+    return rss
+
+def get_driver_rss(driver):
+    try:
+        pid = driver.service.process.pid
+    except AttributeError:
+        return 0
+    return get_process_tree_rss(pid)
+
+class DriverPool():
+    """
+    The web drivers owned by one worker process.
+    One driver is active and spares drivers are launched in background
+    threads so a recycled driver is replaced without waiting for the
+    browser startup. The active driver is recycled after max_tasks tasks
+    or when the driver and browser RSS is above max_rss_mb.
+    close waits at most close_timeout seconds for the drivers still being
+    launched or retired in background, so no browser outlives the worker.
+    """
+    def __init__(self, create_fun, close_fun, spares=1, max_tasks=100, max_rss_mb=1500, name='[pool]',
+                 close_timeout=60):
+        self.create_fun = create_fun
+        self.close_fun = close_fun
+        self.spares = spares
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss_mb*1024*1024
+        self.name = name
+        self.close_timeout = close_timeout
+        self.lock = threading.Lock()
+        self.spare_list = []
+        self.launching = 0
+        self.thread_list = []  #The launcher and closer threads
+        self.driver = None
+        self.task_num = 0
+        self.closed = False
+
+    def start(self):
+        self.fill_spares()
+
+    def launch_spare(self):
+        driver = None
+        try:
+            driver = self.create_fun()
+        except Exception as err:
+            pool_logger.info("%s failed to launch spare driver: %s" %(self.name,err))
+        with self.lock:
+            self.launching -= 1
+            if driver != None and self.closed == False:
+                self.spare_list.append(driver)
+                driver = None
+        if driver != None:
+            self.close_fun(driver)
+
+    def fill_spares(self):
+        with self.lock:
+            need = self.spares-len(self.spare_list)-self.launching
+            if self.closed == True or need <= 0:
+                return
+            self.launching += need
+        for i in range(need):
+            self.start_thread(self.launch_spare)
+
+    def retire_driver(self, driver):
+        self.start_thread(self.close_driver, driver)
+
+    def start_thread(self, target, *args):
+        t = threading.Thread(target=target, args=args, daemon=True)
+        with self.lock:
+            self.thread_list = [x for x in self.thread_list if x.is_alive()]
+            self.thread_list.append(t)
+        t.start()
+
+    def close_driver(self, driver):
+        try:
+            self.close_fun(driver)
+        except Exception as err:
+            pool_logger.info("%s failed to close driver: %s" %(self.name,err))
+
+    def get_driver(self):
+        """
+        Return the active driver, take a spare one or create a new one if
+        there is no active driver.
+        """
+        if self.driver != None:
+            return self.driver
+
+        with self.lock:
+            if len(self.spare_list) > 0:
+                self.driver = self.spare_list.pop(0)
+        if self.driver == None:
+            self.driver = self.create_fun()
+        self.task_num = 0
+        self.fill_spares()
+        return self.driver
+
+    def replace_driver(self, reason):
+        """
+        Retire the active driver. The next get_driver returns a spare.
+        """
+        if self.driver == None:
+            return
+        pool_logger.info("%s recycle driver after %d tasks, reason: %s" %(self.name,self.task_num,reason))
+        self.retire_driver(self.driver)
+        self.driver = None
+
+    def task_done(self):
+        """
+        Called after every task, recycle the driver if it is worn out.
+        """
+        self.task_num += 1
+        if self.task_num >= self.max_tasks:
+            self.replace_driver("max tasks")
+        elif self.max_rss > 0 and get_driver_rss(self.driver) > self.max_rss:
+            self.replace_driver("rss above %d MB" %(self.max_rss/1024/1024))
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            driver_list = self.spare_list
+            self.spare_list = []
+        if self.driver != None:
+            driver_list.append(self.driver)
+            self.driver = None
+        for driver in driver_list:
+            self.close_driver(driver)
+
+        # A spare launched after closed is closed by its launcher thread
+        with self.lock:
+            thread_list = self.thread_list
+            self.thread_list = []
+        end_time = time.time()+self.close_timeout
+        for t in thread_list:
+            t.join(max(0,end_time-time.time()))
+            if t.is_alive():
+                pool_logger.info("%s driver thread still running after %d seconds" %(self.name,self.close_timeout))
+
+def main():
+    print("pid %d rss %d" %(os.getpid(),get_process_tree_rss(os.getpid())))
+
+if __name__=='__main__':
+    main()
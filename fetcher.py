@@ -0,0 +1,471 @@
+#!/usr/local/bin/python3
+# Copyright (C) 2015-2025 Wang,Jing   <jingwangian@gmail.com>
+#
+# This file is part of Flight Inforation Query System (fiqs)
+#
+# fiqs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fiqs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fiqs.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import logging
+import datetime
+import asyncio
+import threading
+import concurrent.futures
+import http.server
+from html.parser import HTMLParser
+
+import aiohttp
+
+import db
+import ratelimit
+import proxy_pool
+import worker_exec as wke
+
+process_name='[fetcher]'
+
+# Adaptive concurrency of run_http_tasks, see ratelimit.AIMDController
+g_http_initial_concurrency = 10
+g_http_target_latency = 5
+g_http_max_error_rate = 0.1
+
+main_logger=logging.getLogger('[Main]')
+
+class ProxyBannedError(Exception):
+    """
+    The site refused the request because of the proxy it came through.
+    """
+    pass
+
+class PageTextParser(HTMLParser):
+    """
+    Convert a html page into the text the browser shows in the body,
+    one text node per line, so the result file looks like the one
+    created from body_element.text.
+    """
+    skip_tags = ('script','style','noscript','head','title')
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.lines = []
+        self.skip_level = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skip_tags:
+            self.skip_level += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.skip_tags and self.skip_level > 0:
+            self.skip_level -= 1
+
+    def handle_data(self, data):
+        if self.skip_level > 0:
+            return
+        for line in data.splitlines():
+            line = line.strip()
+            if len(line) > 0:
+                self.lines.append(line)
+
+def html_to_text(html):
+    parser = PageTextParser()
+    parser.feed(html)
+    parser.close()
+    return '\n'.join(parser.lines)
+
+def bootstrap_session(start_url):
+    """
+    Open one browser, load the start_url and take its cookies and
+    user agent so the http engine looks like the same browser session.
+    Return a session dict:
+        session['cookies'] as a dict name -> value
+        session['headers'] as a dict
+    """
+    driver = wke.createDriver()
+    try:
+        driver.get(start_url)
+        cookies = dict()
+        for c in driver.get_cookies():
+            cookies[c['name']] = c['value']
+        user_agent = driver.execute_script("return navigator.userAgent")
+    finally:
+        wke.closeDriver(driver)
+
+    session = dict()
+    session['cookies'] = cookies
+    session['headers'] = {'User-Agent':user_agent}
+    return session
+
+class AsyncHTTPEngine():
+    """
+    Fetch the result pages with asyncio http requests.
+    Up to concurrency requests are in flight at the same time, all of
+    them sharing the cookies and headers of one bootstrapped session,
+    fewer when a ratelimit.AIMDController limiter is given; a
+    ratelimit.TokenBucket limits the requests per second.
+    Every page is saved by worker_exec.save_page so the result files are
+    the same as the ones written by the selenium workers. With a database
+    fdb, a page unchanged since the last crawl is not saved, see
+    worker_exec.page_unchanged; the check runs in one thread of its own
+    so the event loop never waits for the database.
+    With a proxy_pool.ProxyPool proxies, every request goes through a
+    proxy picked by its health and reports back to it.
+    """
+    def __init__(self, session=None, concurrency=100, timeout=30, worker_num=0, fdb=None,
+                 limiter=None, controller=None, proxies=None):
+        if session == None:
+            session = {'cookies':{}, 'headers':{}}
+        self.session = session
+        self.fdb = fdb
+        self.limiter = limiter
+        self.controller = controller
+        self.proxies = proxies
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.worker_num = worker_num
+        self.ok_num = 0
+        self.fail_num = 0
+        self.unchanged_num = 0
+        self.db_executor = None
+
+    async def fetch_page(self, http_session, req_url, proxy=None):
+        """
+        Return the page text or None if the request failed.
+        Raise ProxyBannedError if the site refused the proxy.
+        """
+        async with http_session.get(req_url, proxy=proxy) as resp:
+            if resp.status in (403, 429) and proxy != None:
+                raise ProxyBannedError("http status %d through %s" %(resp.status,proxy))
+            if resp.status != 200:
+                return None
+            body = await resp.text()
+            if 'html' in resp.headers.get('Content-Type',''):
+                body = html_to_text(body)
+            return body
+
+    async def handle_task(self, http_session, sem, task):
+        flight_id = task['data']
+        req_url = task['url']
+        async with sem:
+            if self.controller != None:
+                await self.controller.acquire_async()
+            if self.limiter != None:
+                await self.limiter.acquire_async()
+            n = None
+            proxy = None
+            if self.proxies != None:
+                n = self.proxies.acquire()
+                proxy = "http://"+self.proxies.address(n)
+            t1 = time.time()
+            text = None
+            banned = False
+            try:
+                text = await self.fetch_page(http_session, req_url, proxy)
+            except Exception as err:
+                # Any error, a bad encoding too, fails this task only
+                main_logger.info("%s request for flight id %d failed: %s" %(process_name,flight_id,err))
+                banned = isinstance(err, ProxyBannedError)
+            finally:
+                latency = time.time()-t1
+                if self.controller != None:
+                    self.controller.release(latency, text != None)
+                if self.proxies != None:
+                    self.proxies.report(n, latency, text != None, banned)
+                    self.proxies.release(n)
+
+        if text == None:
+            self.fail_num += 1
+            return False
+
+        try:
+            unchanged = False
+            if self.fdb != None:
+                loop = asyncio.get_running_loop()
+                unchanged = await loop.run_in_executor(self.db_executor, wke.page_unchanged,
+                                                       self.fdb, flight_id, text)
+            if unchanged == False:
+                wke.save_page(flight_id, req_url, self.worker_num, text)
+        except Exception as err:
+            main_logger.info("%s failed to store the page of flight id %d: %s" %(process_name,flight_id,err))
+            self.fail_num += 1
+            return False
+
+        self.ok_num += 1
+        if unchanged == True:
+            self.unchanged_num += 1
+        return True
+
+    async def crawl(self, task_list):
+        """
+        task_list: every task is a dict with the 'data' (flight_id) and
+        'url' keys.
+        Return a list of bool, True means the page has been fetched.
+        """
+        sem = asyncio.Semaphore(self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        # One thread, the database connection is used by one thread at a time
+        self.db_executor = concurrent.futures.ThreadPoolExecutor(1)
+        try:
+            async with aiohttp.ClientSession(headers=self.session['headers'],
+                                             cookies=self.session['cookies'],
+                                             timeout=timeout,
+                                             connector=connector) as http_session:
+                jobs = [self.handle_task(http_session, sem, task) for task in task_list]
+                return await asyncio.gather(*jobs)
+        finally:
+            self.db_executor.shutdown()
+            self.db_executor = None
+
+    def run(self, task_list):
+        return asyncio.run(self.crawl(task_list))
+
+def run_http_tasks(flight_list, search_date, concurrency=100, rate_limit=0, proxy_list=[]):
+    """
+    Execute the flight_list with the http engine in this process.
+    The status in flight_price_query_task is set to 1 for every task
+    sent, the same as the selenium workers do.
+    The requests in flight adapt between 1 and concurrency from the
+    latency and errors, starting from g_http_initial_concurrency;
+    rate_limit is the maximum requests per second, 0 for no limit.
+    The requests are spread on the proxies of proxy_list by their health,
+    an empty list to go direct.
+    Return the number of fetched pages.
+    """
+    mydb = db.FlightPlanDatabase()
+    mydb.connectDB()
+    try:
+        task_dict = mydb.get_flight_url_by_ids(flight_list)
+        task_list = []
+        for flight_id in flight_list:
+            if flight_id not in task_dict:
+                continue
+            d = dict()
+            d['data'] = flight_id
+            d['url'] = task_dict[flight_id]['url']
+            task_list.append(d)
+
+        if len(task_list) == 0:
+            return 0
+
+        session = bootstrap_session(task_list[0]['url'])
+        controller = ratelimit.AIMDController(min(g_http_initial_concurrency,concurrency), 1, concurrency,
+                                              g_http_target_latency, g_http_max_error_rate,
+                                              name=process_name)
+        limiter = ratelimit.TokenBucket(rate_limit, max(1,rate_limit)) if rate_limit > 0 else None
+        proxies = proxy_pool.ProxyPool(proxy_list) if len(proxy_list) > 0 else None
+        engine = AsyncHTTPEngine(session, concurrency, fdb=mydb, limiter=limiter, controller=controller,
+                                 proxies=proxies)
+
+        for d in task_list:
+            mydb.queue_status_in_flight_price_query_task_tbl(d['data'],1,search_date)
+        mydb.flush_status_in_flight_price_query_task_tbl()
+
+        t1 = datetime.datetime.now()
+        engine.run(task_list)
+        wke.close_page_writer()
+        t2 = datetime.datetime.now()
+        tx = t2-t1
+        main_logger.info("%s http engine got %d pages, %d unchanged, failed %d, cost %d seconds"
+                         %(process_name,engine.ok_num,engine.unchanged_num,engine.fail_num,tx.seconds))
+    finally:
+        mydb.disconnectDB()
+
+    return engine.ok_num
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Local stand-in for the result page server, used by test().
+    """
+    page = '''<html><head><script>var x=1;</script></head><body>
+<div>Result 1, $636.77</div><div>Departure</div><div>10:05am - 9:35pm</div>
+<div>Multiple Airlines</div><div>13h 30m</div><div>SYD - PVG</div>
+<div>1 stop</div><div>1h 15m in HKG</div><div>$636.77</div>
+</body></html>'''
+
+    def do_GET(self):
+        body = self.page.encode()
+        self.send_response(200)
+        self.send_header('Content-Type','text/html; charset=utf-8')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class SlowStubHandler(StubHandler):
+    """
+    Stub server with a capacity: up to capacity requests in flight are
+    answered in latency seconds, the latency grows with the square of the
+    overload above it, and more than twice the capacity gets 503.
+    """
+    capacity = 20
+    latency = 0.05
+    lock = threading.Lock()
+    active = 0
+
+    def do_GET(self):
+        cls = SlowStubHandler
+        with cls.lock:
+            cls.active += 1
+            active = cls.active
+        try:
+            if active > 2*cls.capacity:
+                self.send_response(503)
+                self.send_header('Content-Length','0')
+                self.end_headers()
+                return
+            time.sleep(cls.latency*max(1,active/cls.capacity)**2)
+            StubHandler.do_GET(self)
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+class BlockedStubHandler(StubHandler):
+    """
+    Stub server refusing every request with 403, as the site does for a
+    blacklisted proxy.
+    """
+    def do_GET(self):
+        self.send_response(403)
+        self.send_header('Content-Length','0')
+        self.end_headers()
+
+def start_stub_server(handler=StubHandler):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1',0), handler)
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    return server
+
+def test(task_num=200):
+    """
+    Crawl task_num pages from a local stub server and check the result
+    files can be analyzed.
+    """
+    import result
+    import archive
+    result.logger=logging.getLogger('[result]')
+
+    server = start_stub_server()
+    stub_url = "http://127.0.0.1:%d/Flights-Search" %server.server_address[1]
+
+    task_list = []
+    for i in range(task_num):
+        task_list.append({'data':900000+i, 'url':stub_url+"?id=%d" %i})
+
+    before = set(result.get_all_files('results'))
+    engine = AsyncHTTPEngine(concurrency=50)
+    t1 = time.time()
+    engine.run(task_list)
+    wke.close_page_writer()
+    t2 = time.time()
+    server.shutdown()
+
+    print("saved %d pages, failed %d, cost %.2f seconds" %(engine.ok_num,engine.fail_num,t2-t1))
+
+    saved = 0
+    for f in sorted(set(result.get_all_files('results'))-before):
+        for flight_id,search_date,flight_list,page_hash,fp in result.analyze_one_path(f):
+            print(f, flight_id, search_date, flight_list)
+            saved += 1
+        if f.endswith('.seg'):
+            os.remove(archive.index_name(f))
+        os.remove(f)
+    print("%d of %d pages found" %(saved,task_num))
+
+def test_flow_control(task_num=2000):
+    """
+    Crawl a SlowStubHandler server with the adaptive concurrency and show
+    the limit settling around the capacity of the server.
+    """
+    import result
+    import archive
+
+    server = start_stub_server(SlowStubHandler)
+    stub_url = "http://127.0.0.1:%d/Flights-Search" %server.server_address[1]
+    task_list = [{'data':900000+i, 'url':stub_url+"?id=%d" %i} for i in range(task_num)]
+
+    controller = ratelimit.AIMDController(4, 1, 200, target_latency=2*SlowStubHandler.latency,
+                                          max_error_rate=0.05, name='[stub]')
+    engine = AsyncHTTPEngine(concurrency=200, controller=controller)
+    before = set(result.get_all_files('results'))
+
+    history = []
+    def sample():
+        while server_running[0] == True:
+            history.append(controller.value())
+            time.sleep(0.25)
+    server_running = [True]
+    t = threading.Thread(target=sample, daemon=True)
+    t.start()
+
+    t1 = time.time()
+    try:
+        engine.run(task_list)
+        wke.close_page_writer()
+    finally:
+        server_running[0] = False
+        server.shutdown()
+    t2 = time.time()
+
+    for f in set(result.get_all_files('results'))-before:
+        if f.endswith('.seg'):
+            os.remove(archive.index_name(f))
+        os.remove(f)
+
+    print("limit every 0.25 seconds: %s" %history)
+    print("fetched %d pages, failed %d, %.1f pages/s, server capacity %d"
+          %(engine.ok_num,engine.fail_num,engine.ok_num/(t2-t1),SlowStubHandler.capacity))
+
+def test_proxy_pool(task_num=500):
+    """
+    Crawl through three stub proxies, a good, a slow and a blocked one,
+    and show how the requests were spread. A stub server answers the
+    absolute URI a proxy gets as its own page.
+    """
+    import result
+    import archive
+
+    server_list = [start_stub_server(StubHandler), start_stub_server(SlowStubHandler),
+                   start_stub_server(BlockedStubHandler)]
+    proxy_list = ["127.0.0.1:%d" %server.server_address[1] for server in server_list]
+    SlowStubHandler.latency = 0.5
+    proxies = proxy_pool.ProxyPool(proxy_list)
+    task_list = [{'data':900000+i, 'url':"http://fiqs.invalid/Flights-Search?id=%d" %i}
+                 for i in range(task_num)]
+
+    engine = AsyncHTTPEngine(concurrency=20, proxies=proxies)
+    before = set(result.get_all_files('results'))
+    try:
+        engine.run(task_list)
+        wke.close_page_writer()
+    finally:
+        for server in server_list:
+            server.shutdown()
+
+    for f in set(result.get_all_files('results'))-before:
+        if f.endswith('.seg'):
+            os.remove(archive.index_name(f))
+        os.remove(f)
+
+    print("fetched %d pages, failed %d" %(engine.ok_num,engine.fail_num))
+    for name,(address,latency,ok,fail,banned) in zip(['good','slow','blocked'], proxies.stats()):
+        print("%-8s %s latency %.2f ok %5.1f fail %5.1f banned %s" %(name,address,latency,ok,fail,banned))
+
+def main():
+    test()
+
+if __name__=='__main__':
+    main()
@@ -19,11 +19,13 @@
 import sys
 import os
 import time
+import queue
 import db
 import worker
 import logging
 import datetime
 import result
+import proxy_pool
 
 import multiprocessing as mp
 import worker
@@ -31,6 +33,68 @@ import worker
 main_logger=None
 g_worker_num = 4
 
+# Shared flow control of the selenium workers, off by default: the pages
+# in flight adapt between 1 and g_worker_max_num, from g_worker_num at
+# first, backing off when the mean page latency is above g_target_latency
+# seconds or more than g_max_error_rate of the pages time out; at most
+# g_rate_limit pages per second (0 for no limit). See ratelimit.py.
+# g_worker_max_num workers are started, each with its browsers: raise it
+# above g_worker_num only if the host can run that many browsers.
+g_flow_control = False
+g_worker_max_num = g_worker_num
+g_rate_limit = 0
+g_rate_burst = 4
+g_target_latency = 15
+g_max_error_rate = 0.2
+
+# 'selenium' drives g_worker_num Firefox workers, 'http' runs all tasks
+# through the asyncio http engine in fetcher.py
+g_fetch_engine = 'selenium'
+g_http_concurrency = 100
+g_http_rate_limit = 0
+
+# The proxies of the drivers and of the http engine, one host:port per
+# line; they are rotated by their health, see proxy_pool.py. No file or
+# an empty one to go direct
+g_proxy_file = 'proxy.txt'
+
+# 'queue' puts today's tasks into the task queue, 'db' lets the workers
+# claim the tasks from the database so several hosts can share them
+g_task_source = 'queue'
+
+# Number of processes analyzing the result files and storing them into
+# the database, see result.analyze_results_to_db
+g_analyze_processes = mp.cpu_count()
+g_analyze_writers = 1
+
+# 'watch' ingests every result file when it is finished, 'scan' rescans
+# the results directory every 60 seconds
+g_result_ingest = 'watch'
+
+# 'file' saves every page into a result file analyzed by the result
+# process, 'direct' lets the workers parse the pages in memory and send
+# the fares over a queue of g_page_queue_size pages to a DB writer process
+g_pipeline_mode = 'file'
+g_page_queue_size = 100
+
+# flight_price partitions are created this many months ahead; when
+# g_price_keep_months is more than 0 older months are moved to flight_archive
+g_price_partition_ahead_months = 2
+g_price_keep_months = 0
+
+# Days the ingested pages are kept in ingest_manifest
+g_manifest_keep_days = 30
+
+# Priority scheduler: today's tasks are executed by a score weighing the
+# days to departure, the price variance of the last g_priority_window_days
+# days and the days since the last crawl; a task scored below
+# g_priority_skip_score skips the day, at most g_priority_max_skip_days
+# days in a row. See score_query_tasks in functions.sql.
+g_priority_weights = (1.0, 1.0, 0.5)
+g_priority_window_days = 14
+g_priority_skip_score = 0.3
+g_priority_max_skip_days = 3
+
 process_name='[main]'
 
 logger_handle = None
@@ -50,86 +114,172 @@ def start_task():
     
     mydb.create_today_task()
     
+    # flight_price partitions of the coming months, and retention of old ones
+    detached = mydb.manage_flight_price_partitions(g_price_partition_ahead_months, g_price_keep_months)
+    if len(detached) > 0:
+        main_logger.info("%s Archived flight_price partitions %s" %(process_name,','.join(detached)))
+    mydb.prune_ingest_manifest(g_manifest_keep_days)
+    
+    w_departure,w_volatility,w_stale = g_priority_weights
+    scored,skipped = mydb.score_today_tasks(w_departure, w_volatility, w_stale,
+                                            g_priority_window_days,
+                                            g_priority_skip_score,
+                                            g_priority_max_skip_days)
+    main_logger.info("%s Scored %d tasks, %d low priority tasks skip today" %(process_name,scored,skipped))
+    
     i = 0
     total_tasks = 0
     
-    result_p = start_handle_result_process()
-    result_p.start()
-
     wkm = worker.WorkerMonitor()
     
     task_q,result_q = wkm.create_queue()
     
+    worker_num = g_worker_num
+    if g_flow_control == True:
+        wkm.create_flow_control(g_rate_limit, g_rate_burst, g_worker_num,
+                                g_worker_max_num, g_target_latency, g_max_error_rate)
+        worker_num = max(g_worker_num, g_worker_max_num)
+    
+    proxy_list = proxy_pool.load_proxy_list(g_proxy_file)
+    wkm.create_proxy_pool(proxy_list)
+    if len(proxy_list) > 0:
+        main_logger.info("%s %d proxies in %s" %(process_name,len(proxy_list),g_proxy_file))
+    
+    if g_pipeline_mode == 'direct':
+        page_q = wkm.create_page_queue(g_page_queue_size)
+        result_p = mp.Process(target=result.pipeline_writer_exec, args=(page_q,))
+    else:
+        result_p = start_handle_result_process()
+    result_p.start()
+    
     try:
-        while 1:
-            flight_list = mydb.get_today_task_id(max_task_num)
-            num_tasks = len(flight_list)
-            
-            if num_tasks == 0:
-                break
-            
-            total_tasks += num_tasks 
-            
+        if g_task_source == 'db':
             print("Starting workers")
-            wkm.start_workers(g_worker_num)
+            wkm.start_workers(worker_num)
             
             print("Starting worker monitor")
             wkm.start_monitor()
-                        
+            
             t1 = datetime.datetime.now()
-            #Put task list
-            for flight_id in flight_list:
+            for i in range(worker_num):
                 d = dict()
-                d['cmd']='continue'
-                d['data'] = flight_id
+                d['cmd']='claim'
                 d['date'] = t1.strftime('%Y-%m-%d')
                 task_q.put(d)
-                i +=1
-    
-            main_logger.info("%s Put total %d task into queue" %(process_name,num_tasks))
             
-            wait_tasks_finished(result_q, num_tasks)
+            total_tasks = wait_claims_finished(result_q, worker_num)
+        else:
+            while 1:
+                flight_list = mydb.get_today_task_id(max_task_num)
+                num_tasks = len(flight_list)
             
-            time.sleep(10)
+                if num_tasks == 0:
+                    break
             
-            break
+                total_tasks += num_tasks 
+            
+                if g_fetch_engine == 'http':
+                    # aiohttp is only needed by the http engine
+                    import fetcher
+                    t1 = datetime.datetime.now()
+                    fetcher.run_http_tasks(flight_list, t1.strftime('%Y-%m-%d'), g_http_concurrency, g_http_rate_limit,
+                                           proxy_list)
+                    break
+            
+                print("Starting workers")
+                wkm.start_workers(worker_num)
+            
+                print("Starting worker monitor")
+                wkm.start_monitor()
+                        
+                t1 = datetime.datetime.now()
+                # Hydrate the whole batch with one query
+                task_dict = mydb.get_flight_url_by_ids(flight_list)
+                #Put task list
+                for flight_id in flight_list:
+                    d = dict()
+                    d['cmd']='continue'
+                    d['data'] = flight_id
+                    d['date'] = t1.strftime('%Y-%m-%d')
+                    if flight_id in task_dict:
+                        d['url'] = task_dict[flight_id]['url']
+                        d['flight'] = task_dict[flight_id]['flight']
+                    task_q.put(d)
+                    i +=1
+    
+                main_logger.info("%s Put total %d task into queue" %(process_name,num_tasks))
+            
+                wait_tasks_finished(result_q, num_tasks)
+            
+                break
     except Exception as err:
-        main_logger.info("%s In start_task error happened: %s" %str(err))
+        main_logger.info("%s In start_task error happened: %s" %(process_name,str(err)))
     finally:
         main_logger.info("%s Total tasks %d has been executed" %(process_name,total_tasks))
         
-        time.sleep(10)
-        
         main_logger.info("%s Stop the handle result process" %process_name)
 
         #Send EXIT command to workers
-        for i in range(g_worker_num):
+        for i in range(worker_num):
             d = dict()
             d['cmd']='exit'
             task_q.put(d)
 
         #Wait workers exit
-        print("Waiting 30 seconds for workers finishing their final works")                       
-        time.sleep(30)
+        print("Waiting at most 30 seconds for workers finishing their final works")
+        wkm.join_workers(30)
                         
         wkm.stop_workers()
         wkm.stop_monitor()
         mydb.disconnectDB()
+        if g_pipeline_mode == 'direct':
+            page_q.put(None)
         result_p.join()
 
-def wait_tasks_finished(result_q, total_task_num):
+def wait_tasks_finished(result_q, total_task_num, max_idle_time=600):
+    """
+    Block on result_q until every task has reported it is finished.
+    Give up if no task finished in max_idle_time seconds, e.g. the
+    workers have died.
+    """
     task_num = 0
-    while(1):
-        if result_q.empty() == True:
-            time.sleep(5)
-            continue
-        num = result_q.get()
+    while task_num<total_task_num:
+        try:
+            result_q.get(timeout=max_idle_time)
+        except queue.Empty:
+            main_logger.info("%s No task finished in %d seconds, %d of %d tasks done"
+                             %(process_name,max_idle_time,task_num,total_task_num))
+            break
         task_num = task_num+1
-        if task_num>=total_task_num:
+
+def wait_claims_finished(result_q, worker_num, max_idle_time=600):
+    """
+    Block on result_q until every worker has no task left to claim.
+    Return the number of tasks executed by the workers.
+    """
+    task_num = 0
+    done_num = 0
+    while done_num<worker_num:
+        try:
+            flight_id = result_q.get(timeout=max_idle_time)
+        except queue.Empty:
+            main_logger.info("%s No task finished in %d seconds, %d of %d workers done"
+                             %(process_name,max_idle_time,done_num,worker_num))
             break
+        if flight_id == None:
+            done_num = done_num+1
+        else:
+            task_num = task_num+1
+    
+    return task_num
 
 def start_handle_result_process():
-    p = mp.Process(target=result.schedule_results_analyze, args=('results',60))
+    if g_result_ingest == 'watch':
+        p = mp.Process(target=result.ingest_results,
+                       args=('results',g_analyze_processes))
+    else:
+        p = mp.Process(target=result.schedule_results_analyze,
+                       args=('results',60,g_analyze_processes,g_analyze_writers))
     
     return p
     
@@ -0,0 +1,169 @@
+#!/usr/local/bin/python3
+# Copyright (C) 2015-2025 Wang,Jing   <jingwangian@gmail.com>
+#
+# This file is part of Flight Inforation Query System (fiqs)
+#
+# fiqs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fiqs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fiqs.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import random
+import logging
+import multiprocessing as mp
+
+proxy_logger = logging.getLogger('[Worker]')
+
+def load_proxy_list(filename):
+    """
+    Read the proxies from filename, one host:port per line, the lines
+    starting with # are comments. Return [] if the file does not exist.
+    """
+    proxy_list = []
+    try:
+        with open(filename) as f:
+            for line in f:
+                line = line.strip()
+                if len(line) > 0 and not line.startswith('#'):
+                    proxy_list.append(line)
+    except FileNotFoundError:
+        pass
+    return proxy_list
+
+class ProxyPool():
+    """
+    The proxies shared by the worker processes with their health: the
+    mean latency (moving average), the successes and failures of the
+    recent requests and a ban time.
+    acquire picks a proxy at random weighted by its score
+        success rate / (latency + 0.1) / (1 + drivers or sessions using it)
+    so the traffic moves away from slow and failing proxies by itself and
+    is spread on the good ones. A proxy is banned for ban_seconds when the
+    site refused it, or when more than max_fail_rate of at least
+    min_samples recent requests failed.
+    The health lives in multiprocessing shared memory, create the pool in
+    the main process before the workers are started.
+    """
+    def __init__(self, proxy_list, ban_seconds=600, max_fail_rate=0.5, min_samples=5,
+                 window=50, alpha=0.2):
+        n = len(proxy_list)
+        self.proxy_list = list(proxy_list)
+        self.ban_seconds = ban_seconds
+        self.max_fail_rate = max_fail_rate
+        self.min_samples = min_samples
+        self.window = window
+        self.alpha = alpha
+        self.lock = mp.Lock()
+        self.latency = mp.Array('d', [1.0]*n, lock=False)
+        self.ok_num = mp.Array('d', n, lock=False)
+        self.fail_num = mp.Array('d', n, lock=False)
+        self.ban_until = mp.Array('d', n, lock=False)
+        self.in_use = mp.Array('i', n, lock=False)
+
+    def __len__(self):
+        return len(self.proxy_list)
+
+    def address(self, n):
+        return self.proxy_list[n]
+
+    def score(self, n):
+        success_rate = (self.ok_num[n]+1)/(self.ok_num[n]+self.fail_num[n]+2)
+        return success_rate/(self.latency[n]+0.1)/(1+self.in_use[n])
+
+    def acquire(self):
+        """
+        Return the number of the proxy to use, or None if the pool is empty.
+        When all proxies are banned the one whose ban ends first is used.
+        """
+        if len(self.proxy_list) == 0:
+            return None
+        with self.lock:
+            now = time.time()
+            n_list = [n for n in range(len(self.proxy_list)) if self.ban_until[n] <= now]
+            if len(n_list) == 0:
+                n = min(range(len(self.proxy_list)), key=lambda i:self.ban_until[i])
+            else:
+                n = random.choices(n_list, weights=[self.score(i) for i in n_list])[0]
+            self.in_use[n] += 1
+        return n
+
+    def release(self, n):
+        if n == None:
+            return
+        with self.lock:
+            self.in_use[n] -= 1
+
+    def report(self, n, latency, ok, banned=False):
+        """
+        Record a request through proxy n: its latency in seconds, ok False
+        for an error or a time-out, banned True if the site refused the
+        proxy.
+        """
+        if n == None:
+            return
+        with self.lock:
+            self.latency[n] = (1-self.alpha)*self.latency[n]+self.alpha*latency
+            if ok == True:
+                self.ok_num[n] += 1
+            else:
+                self.fail_num[n] += 1
+            total = self.ok_num[n]+self.fail_num[n]
+            fail_rate = self.fail_num[n]/total
+            ban = banned == True or (total >= self.min_samples and fail_rate > self.max_fail_rate)
+            if ban == True:
+                self.ban_until[n] = time.time()+self.ban_seconds
+                # Start again with a clean record after the ban
+                self.ok_num[n] = 0
+                self.fail_num[n] = 0
+            elif total > self.window:
+                # Forget the old requests
+                self.ok_num[n] /= 2
+                self.fail_num[n] /= 2
+
+        if ban == True:
+            proxy_logger.info("[proxy] %s banned for %d seconds, fail rate %.2f, latency %.2f"
+                              %(self.proxy_list[n],self.ban_seconds,fail_rate,self.latency[n]))
+
+    def is_banned(self, n):
+        return n != None and self.ban_until[n] > time.time()
+
+    def stats(self):
+        """
+        Return a list of (address, latency, ok, fail, banned) of the proxies.
+        """
+        return [(self.proxy_list[n],self.latency[n],self.ok_num[n],self.fail_num[n],self.is_banned(n))
+                for n in range(len(self.proxy_list))]
+
+def test():
+    """
+    Route 1000 simulated requests through a fast, a slow, a failing and a
+    banned proxy and show where they went.
+    """
+    behaviour = {'fast:1':(0.05,0.0), 'slow:2':(1.0,0.0), 'failing:3':(0.05,0.7), 'banned:4':(0.05,1.0)}
+    pool = ProxyPool(list(behaviour))
+    count = dict([(p,0) for p in behaviour])
+    for i in range(1000):
+        n = pool.acquire()
+        latency,fail_rate = behaviour[pool.address(n)]
+        count[pool.address(n)] += 1
+        ok = random.random() >= fail_rate
+        pool.report(n, latency, ok, pool.address(n) == 'banned:4')
+        pool.release(n)
+    for address,latency,ok,fail,banned in pool.stats():
+        print("%-10s requests %4d latency %.2f ok %5.1f fail %5.1f banned %s"
+              %(address,count[address],latency,ok,fail,banned))
+
+def main():
+    test()
+
+if __name__=='__main__':
+    main()
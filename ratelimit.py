@@ -0,0 +1,176 @@
+#!/usr/local/bin/python3
+# Copyright (C) 2015-2025 Wang,Jing   <jingwangian@gmail.com>
+#
+# This file is part of Flight Inforation Query System (fiqs)
+#
+# fiqs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fiqs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fiqs.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Flow control of the requests sent to the target host, shared by the
+worker processes: the state lives in multiprocessing shared memory, so the
+objects are created in the main process and passed to the workers.
+"""
+
+import time
+import asyncio
+import logging
+import multiprocessing as mp
+
+flow_logger = logging.getLogger('[Worker]')
+
+class TokenBucket():
+    """
+    At most rate requests per second to the host on average, with bursts
+    of up to burst requests.
+    """
+    def __init__(self, rate, burst=1):
+        self.lock = mp.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = mp.Value('d', burst, lock=False)
+        self.last = mp.Value('d', time.time(), lock=False)
+
+    def try_acquire(self):
+        """
+        Take a token. Return 0 if one was taken, or the seconds to wait for
+        the next token.
+        """
+        with self.lock:
+            now = time.time()
+            tokens = min(self.burst, self.tokens.value+(now-self.last.value)*self.rate)
+            self.last.value = now
+            if tokens >= 1:
+                self.tokens.value = tokens-1
+                return 0
+            self.tokens.value = tokens
+            return (1-tokens)/self.rate
+
+    def acquire(self, timeout=None):
+        """
+        Wait for a token, return False if none came in timeout seconds.
+        """
+        end_time = None if timeout == None else time.time()+timeout
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return True
+            if end_time != None and time.time()+wait > end_time:
+                return False
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
+
+class AIMDController():
+    """
+    Limit of the requests in flight to the host, adapted with additive
+    increase / multiplicative decrease.
+    After every window of finished requests (the current limit, at least
+    min_samples) the limit is multiplied by decrease if the error rate is
+    above max_error_rate or the mean latency is above target_latency
+    seconds, otherwise increase is added, within [min_limit, max_limit].
+    The latency goes up before the host starts refusing requests, so the
+    limit backs off before the errors come. The requests sent before a
+    decrease are not counted after it, they were sent at the old limit.
+    """
+    def __init__(self, initial, min_limit=1, max_limit=16, target_latency=10,
+                 max_error_rate=0.1, increase=1, decrease=0.5, min_samples=4, name='[flow]'):
+        self.lock = mp.Lock()
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.min_samples = min_samples
+        self.name = name
+        self.limit = mp.Value('d', initial, lock=False)
+        self.active = mp.Value('i', 0, lock=False)
+        self.done = mp.Value('i', 0, lock=False)
+        self.errors = mp.Value('i', 0, lock=False)
+        self.latency_sum = mp.Value('d', 0, lock=False)
+        self.cut_time = mp.Value('d', 0, lock=False)
+
+    def try_acquire(self):
+        with self.lock:
+            if self.active.value < int(self.limit.value):
+                self.active.value += 1
+                return True
+            return False
+
+    def acquire(self, timeout=None, poll=0.05):
+        """
+        Wait until a request can be sent, return False if it could not in
+        timeout seconds. Every acquire is followed by a release.
+        """
+        end_time = None if timeout == None else time.time()+timeout
+        while self.try_acquire() == False:
+            if end_time != None and time.time() >= end_time:
+                return False
+            time.sleep(poll)
+        return True
+
+    async def acquire_async(self, poll=0.01):
+        while self.try_acquire() == False:
+            await asyncio.sleep(poll)
+
+    def release(self, latency, ok):
+        """
+        Report a finished request: its latency in seconds and ok False for
+        an error or a time-out.
+        """
+        now = time.time()
+        with self.lock:
+            self.active.value -= 1
+            if now-latency < self.cut_time.value:
+                return
+            self.done.value += 1
+            self.latency_sum.value += latency
+            if ok == False:
+                self.errors.value += 1
+
+            if self.done.value < max(self.min_samples, int(self.limit.value)):
+                return
+            error_rate = self.errors.value/self.done.value
+            latency = self.latency_sum.value/self.done.value
+            old_limit = self.limit.value
+            if error_rate > self.max_error_rate or latency > self.target_latency:
+                self.limit.value = max(self.min_limit, old_limit*self.decrease)
+                self.cut_time.value = now
+            else:
+                self.limit.value = min(self.max_limit, old_limit+self.increase)
+            self.done.value = 0
+            self.errors.value = 0
+            self.latency_sum.value = 0
+
+        if int(self.limit.value) != int(old_limit):
+            flow_logger.info("%s limit %d -> %d, latency %.2f seconds, error rate %.2f"
+                             %(self.name,old_limit,self.limit.value,latency,error_rate))
+
+    def value(self):
+        return int(self.limit.value)
+
+def main():
+    bucket = TokenBucket(20, 5)
+    t1 = time.time()
+    for i in range(45):
+        bucket.acquire()
+    print("45 tokens at 20/s with a burst of 5 in %.2f seconds" %(time.time()-t1))
+
+if __name__=='__main__':
+    main()
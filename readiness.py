@@ -0,0 +1,258 @@
+#!/usr/local/bin/python3
+# Copyright (C) 2015-2025 Wang,Jing   <jingwangian@gmail.com>
+#
+# This file is part of Flight Inforation Query System (fiqs)
+#
+# fiqs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fiqs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fiqs.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import collections
+import urllib.parse
+
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+
+# The result list, the marker every finished page has (the one the old
+# fixed wait looked for) and the message of a search without any result
+RESULT_CSS = '.flight-module'
+PAGE_CSS = '#feedbackAndImprovements'
+NO_RESULT_CSS = '.no-results-message, #noResultsMessage'
+
+class ReadyStrategy():
+    """
+    Base class of the page readiness strategies.
+    A strategy is polled by WebDriverWait every poll seconds until
+    is_ready returns True or its timeout expires.
+    """
+    name = 'base'
+
+    def __init__(self, timeout=10, poll=0.5):
+        self.timeout = timeout
+        self.poll = poll
+
+    def reset(self):
+        pass
+
+    def is_ready(self, driver):
+        raise NotImplementedError
+
+    def is_empty(self, driver):
+        """
+        Called when the strategy timed out: return True if the page is a
+        finished search without any result rather than a timeout.
+        """
+        return False
+
+    def __call__(self, driver):
+        return self.is_ready(driver)
+
+    def wait(self, driver, timeout=None):
+        """
+        Return True if the page became ready in the timeout.
+        The timeout can only shorten the strategy's own timeout.
+        """
+        if timeout == None or timeout > self.timeout:
+            timeout = self.timeout
+        self.reset()
+        try:
+            WebDriverWait(driver, timeout, poll_frequency=self.poll).until(self)
+            return True
+        except TimeoutException:
+            return False
+
+class ElementReady(ReadyStrategy):
+    """
+    Ready when the result list element, the page marker or the no-result
+    message is in the DOM, so a search without any result is not a
+    timeout.
+    """
+    name = 'element'
+
+    def __init__(self, by=By.CSS_SELECTOR, value=', '.join([RESULT_CSS,PAGE_CSS,NO_RESULT_CSS]),
+                 timeout=20, poll=0.5):
+        ReadyStrategy.__init__(self, timeout, poll)
+        self.by = by
+        self.value = value
+
+    def is_ready(self, driver):
+        return len(driver.find_elements(self.by, self.value)) > 0
+
+class StableCountReady(ReadyStrategy):
+    """
+    Ready when the number of result elements is more than 0 and has not
+    changed for stable_polls polls in a row.
+    A page without results is ready at once when it shows the no-result
+    message. The page marker can come before the result list, so a page
+    with only the marker is taken as empty when the whole budget of the
+    route has passed, see is_empty; the timeout is as long as the longest
+    budget for that.
+    """
+    name = 'stable_count'
+
+    def __init__(self, css=RESULT_CSS, stable_polls=3, timeout=25, poll=0.5,
+                 page_css=PAGE_CSS, no_result_css=NO_RESULT_CSS):
+        ReadyStrategy.__init__(self, timeout, poll)
+        self.css = css
+        self.stable_polls = stable_polls
+        self.page_css = page_css
+        self.no_result_css = no_result_css
+        self.reset()
+
+    def reset(self):
+        self.last_count = -1
+        self.same_times = 0
+
+    def is_ready(self, driver):
+        count = len(driver.find_elements(By.CSS_SELECTOR, self.css))
+        if count == 0 and len(driver.find_elements(By.CSS_SELECTOR, self.no_result_css)) > 0:
+            return True
+        if count > 0 and count == self.last_count:
+            self.same_times += 1
+        else:
+            self.same_times = 0
+        self.last_count = count
+        return self.same_times >= self.stable_polls
+
+    def is_empty(self, driver):
+        if len(driver.find_elements(By.CSS_SELECTOR, self.css)) > 0:
+            return False
+        return len(driver.find_elements(By.CSS_SELECTOR, self.page_css+', '+self.no_result_css)) > 0
+
+class NetworkIdleReady(ReadyStrategy):
+    """
+    Ready when the document is loaded and no new resource request has
+    been started for idle_time seconds.
+    """
+    name = 'network_idle'
+
+    script = '''return [document.readyState,
+                        performance.getEntriesByType('resource').length];'''
+
+    def __init__(self, idle_time=1.5, timeout=15, poll=0.5):
+        ReadyStrategy.__init__(self, timeout, poll)
+        self.idle_time = idle_time
+        self.reset()
+
+    def reset(self):
+        self.last_count = -1
+        self.idle_since = None
+
+    def is_ready(self, driver):
+        state,count = driver.execute_script(self.script)
+        now = time.time()
+        if state != 'complete' or count != self.last_count:
+            self.last_count = count
+            self.idle_since = now
+            return False
+        return now-self.idle_since >= self.idle_time
+
+def get_route(url):
+    """
+    Return the route of a request url as a string 'from>to', the trip
+    and dates are not part of the route.
+    """
+    query = urllib.parse.urlparse(url).query
+    legs = urllib.parse.parse_qs(query).get('leg1')
+    if legs == None:
+        return url
+    route = dict()
+    for item in legs[0].split(','):
+        if ':' in item:
+            k,v = item.split(':',maxsplit=1)
+            route[k] = v
+    return "%s>%s" %(route.get('from',''), route.get('to',''))
+
+class ReadyStats():
+    """
+    Record the observed time-to-ready of every route and give the wait
+    budget for the next request of that route.
+    The budget is the 90th percentile of the last window samples times
+    factor, limited to [min_budget, max_budget]. Until min_samples have
+    been seen the max_budget is used.
+    """
+    def __init__(self, window=50, min_samples=5, min_budget=5, max_budget=25, factor=1.5):
+        self.window = window
+        self.min_samples = min_samples
+        self.min_budget = min_budget
+        self.max_budget = max_budget
+        self.factor = factor
+        self.samples = dict()
+
+    def record(self, route, seconds):
+        if route not in self.samples:
+            self.samples[route] = collections.deque(maxlen=self.window)
+        self.samples[route].append(seconds)
+
+    def record_timeout(self, route):
+        """
+        A timeout counts as a sample of max_budget, so the budget of a
+        slow route grows back.
+        """
+        self.record(route, self.max_budget)
+
+    def budget(self, route):
+        samples = self.samples.get(route)
+        if samples == None or len(samples) < self.min_samples:
+            return self.max_budget
+        s = sorted(samples)
+        p90 = s[int(0.9*(len(s)-1))]
+        b = p90*self.factor
+        if b < self.min_budget:
+            b = self.min_budget
+        if b > self.max_budget:
+            b = self.max_budget
+        return b
+
+class ReadinessChecker():
+    """
+    Wait for a page with a chain of strategies. Every strategy must be
+    ready in turn, all of them sharing the budget of the route.
+    """
+    def __init__(self, strategies=None, stats=None):
+        if strategies == None:
+            strategies = [ElementReady(), StableCountReady()]
+        if stats == None:
+            stats = ReadyStats()
+        self.strategies = strategies
+        self.stats = stats
+
+    def wait(self, driver, url):
+        """
+        Return a tuple (ready, seconds, strategy_name).
+        strategy_name is the strategy which timed out when ready is False,
+        or 'empty' for a page without any result.
+        """
+        route = get_route(url)
+        budget = self.stats.budget(route)
+        t1 = time.time()
+        for strategy in self.strategies:
+            remaining = budget-(time.time()-t1)
+            if remaining <= 0 or strategy.wait(driver, remaining) == False:
+                if strategy.is_empty(driver) == True:
+                    seconds = time.time()-t1
+                    self.stats.record(route, seconds)
+                    return True,seconds,'empty'
+                self.stats.record_timeout(route)
+                return False,time.time()-t1,strategy.name
+
+        seconds = time.time()-t1
+        self.stats.record(route, seconds)
+        return True,seconds,self.strategies[-1].name
+
+def main():
+    print(get_route("https://www.expedia.com.au/Flights-Search?mode=search&leg1=from:sydney,to:beijing,departure:01-02-2017TANYT&trip=oneway"))
+
+if __name__=='__main__':
+    main()
@@ -16,8 +16,8 @@
 # You should have received a copy of the GNU General Public License
 # along with fiqs.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import sys
-import subprocess
 import datetime
 from enum import Enum
 
@@ -100,11 +100,12 @@ class Recorder():
     def finish(self):
         """
         rename the file._xt to file.txt 
+        The file is closed first, so a reader woken up by the rename always
+        sees the whole content.
         """
         try:
-            retcode = subprocess.call("mv "+self.filename+" "+self.finalname, shell=True)
-            if retcode<0:
-                print("Child was terminated by signal",retcode, file=sys.stderr)
+            self.f.close()
+            os.rename(self.filename, self.finalname)
         except OSError as e:
             print("Execution failed:", e, file=sys.stderr)
             
@@ -18,15 +18,37 @@
 
 import os
 import sys
+import queue
 
 import time
 import datetime
 import logging
 import db
 import re
+import shutil
+import signal
+import hashlib
+import archive
+import watcher
+import multiprocessing as mp
 from enum import Enum
 
-logger = None
+logger = logging.getLogger('[result]')
+
+# The results directory holds result files (.txt) written by Recorder and
+# segments (.seg) written by archive.SegmentWriter
+result_suffix = ('.txt','.seg')
+
+# Ingested results are kept in segments in g_archive_dir, a result file is
+# appended to the archive_writer segment of the ingesting process
+g_archive_dir = 'archive'
+archive_writer = None
+
+# Patterns of the time line in a result block, e.g.
+#     10:05am - 9:35pm
+#     10:05pm - 6:15am +1
+time_pattern = re.compile(b'.*m - .*m$')
+span_time_pattern = re.compile(b'.*m - .*m +.*$')
 
 class BlockParserStat(Enum):
     not_start = 0
@@ -54,15 +76,30 @@ def print_flight_list(fdb, flight_id,search_date,flight_list):
     
     print('\n\n')
                 
-def update_flight_list_into_db(fdb, flight_id,search_date,flight_list,value):
+def update_flight_list_into_db(fdb, flight_id,search_date,flight_list,value,page_hash=None,source=None,
+                               fingerprint=None):
+    """
+    Store the fares of one page. The page fingerprint moves on only once
+    its fares are committed, so an unchanged page is never taken for fares
+    which were not stored, see worker_exec.page_unchanged. A failed
+    fingerprint update is only logged, the fares stay committed and the
+    page is crawled again next time.
+    """
+    global logger
+    
     flight_list_len = len(flight_list)
     if flight_list_len > 0:
-        fdb.update_status_in_flight_price_query_task_tbl(flight_id, value, search_date)
+        fdb.queue_status_in_flight_price_query_task_tbl(flight_id, value, search_date)
 
-        for flight_info in flight_list:
-            fdb.add_into_flight_price_tbl(flight_info)
+        row_num = fdb.add_flight_list_into_flight_price_tbl(flight_list, page_hash, source)
+        if fingerprint != None and row_num > 0:
+            try:
+                fdb.update_page_fingerprint(int(flight_id), fingerprint, search_date)
+            except Exception as e:
+                logger.error("Error happened in updating the page fingerprint of %s [%s],Error is: %s "
+                             %(source, flight_id, e))
     else:
-        fdb.update_status_in_flight_price_query_task_tbl(flight_id, 0, search_date)
+        fdb.queue_status_in_flight_price_query_task_tbl(flight_id, 0, search_date)
   
 def get_all_files(dir_name):
     """
@@ -70,11 +107,13 @@ def get_all_files(dir_name):
     """
     file_list=[]
     for root,dirs,files in os.walk(dir_name):
-        new_files=sorted(files,key=sort_fun)
+        # By flight id, then by name so the days of one flight keep their order
+        # (by worker process id for the segments)
+        files = [f for f in files if f.endswith(result_suffix)]
+        new_files=sorted(files,key=lambda name:(sort_fun(name),name))
         for f in new_files:
-            if '.txt' in f:
-                new_f=os.path.join(root,f)
-                file_list.append(new_f)
+            new_f=os.path.join(root,f)
+            file_list.append(new_f)
             
     return file_list
     
@@ -128,6 +167,52 @@ def get_block_list(lines):
     block_list.append(block_info)
     return block_list
 
+class NoBlockError(ValueError):
+    """
+    The page has no result block at all.
+    """
+    pass
+
+def iter_block(lines):
+    """
+    Same as get_block_list but yield every block as soon as it is complete,
+    so only one block is in memory whatever the size of the page.
+    lines can be any iterable of lines, e.g. an open file.
+    Raise NoBlockError if there is no block at all.
+    """
+    fsm_state = BlockParserStat.not_start
+    block_info = None
+    for line in lines:
+        if line.startswith(b'Result '):
+            if fsm_state == BlockParserStat.not_start:
+                fsm_state = BlockParserStat.start_block
+                block_info = [line]
+            elif fsm_state == BlockParserStat.in_block:
+                fsm_state = BlockParserStat.start_block
+                yield block_info
+                block_info = [line]
+        elif fsm_state != BlockParserStat.not_start:
+            fsm_state = BlockParserStat.in_block
+            block_info.append(line)
+
+    if block_info == None:
+        raise NoBlockError("no result block found")
+    
+    #Yield the last one,don't forget it
+    yield block_info
+
+def iter_flight_info(lines, flight_id=None, search_date=None):
+    """
+    Parse the lines of a result page and yield a flight_info dict for every
+    result block, with the 'id' and 'search_date' keys set.
+    """
+    for block in iter_block(lines):
+        flight_info = parse_block_info(block)
+        if flight_info != None:
+            flight_info['id'] = flight_id
+            flight_info['search_date'] = search_date
+            yield flight_info
+
 def parse_block_info(block_info):
     """
     Input is a block_info with list type contains the flight inforation as following:
@@ -176,7 +261,7 @@ def parse_block_info(block_info):
     j=1
     for line in block_info:
         s = line
-        if re.search(b'.*m - .*m$',s)!=None:
+        if time_pattern.search(s)!=None:
             t = s.split(b'-',maxsplit=1)
             dep_time = t[0].strip()
             arr_time = t[1].strip()
@@ -202,7 +287,7 @@ def parse_block_info(block_info):
                 flight_info['stop_info'] = stop_info.decode()
             else:
                 flight_info['stop_info'] = ''
-        elif re.search(b'.*m - .*m +.*$',s)!=None:
+        elif span_time_pattern.search(s)!=None:
             t = s.split(b'-',maxsplit=1)
             dep_time = t[0].strip()
             t2 = t[1].split(b'+',maxsplit=1)
@@ -234,6 +319,72 @@ def parse_block_info(block_info):
 
     return flight_info
         
+def parse_page_text(text, flight_id, search_date):
+    """
+    Parse the text of a result page held in memory, e.g. body_element.text,
+    and return the flight_list like analyze_one_file. A page without any
+    result block gives an empty list.
+    """
+    return parse_page_body(text.encode(), flight_id, search_date)
+
+def parse_page_body(body, flight_id, search_date):
+    """
+    Same as parse_page_text for the page text as bytes, e.g. the body of
+    an archive record. An error in a block is raised.
+    """
+    lines = body.splitlines(keepends=True)
+    try:
+        return list(iter_flight_info(lines, flight_id, search_date))
+    except NoBlockError:
+        return []
+
+class HashedLines():
+    """
+    Read the lines of a result file and compute its page_hash and
+    page_fingerprint on the way, so the file is read only once. The first
+    header_num lines are the header, left out of the fingerprint.
+    """
+    def __init__(self, f, header_num=4):
+        self.f = f
+        self.header_num = header_num
+        self.line_num = 0
+        self.hash = hashlib.sha1()
+        self.fingerprint = hashlib.sha1()
+        # the new lines not yet in the fingerprint, page_fingerprint
+        # leaves out the ones at the end of the page
+        self.newlines = b''
+
+    def readline(self):
+        line = self.f.readline()
+        if len(line) > 0:
+            self.hash.update(line)
+            self.line_num += 1
+            if self.line_num > self.header_num:
+                text = line.rstrip(b'\n')
+                if len(text) > 0:
+                    self.fingerprint.update(self.newlines)
+                    self.fingerprint.update(text)
+                    self.newlines = b''
+                self.newlines += line[len(text):]
+        return line
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if len(line) == 0:
+            raise StopIteration
+        return line
+
+    def digests(self):
+        """
+        Read the rest of the file, return (page_hash, fingerprint).
+        """
+        for line in self:
+            pass
+        return self.hash.digest(),self.fingerprint.digest()
+
 def analyze_one_file(filename):
     """
     Analyze one result file and return the result as a tuple
@@ -250,16 +401,28 @@ def analyze_one_file(filename):
         flight_info['stop'] as a string --- n stop  or direct
         flight_info['stop_info'] as a string --- stop information
     """
+    return analyze_hashed_file(filename)[0:3]
+
+def analyze_hashed_file(filename):
+    """
+    Same as analyze_one_file, return (flight_id, search_date, flight_list,
+    page_hash, fingerprint) with the hashes computed in the same read of
+    the file. The hashes are None if the file failed to analyze or has no
+    flight id.
+    """
     global logger
     
     flight_id=None
     search_date="None"
     flight_list=[]
+    h = None
+    fp = None
     
     try:
         t1 = datetime.datetime.now()
     
-        with open(filename,'rb') as f:
+        with open(filename,'rb') as raw_file:
+            f = HashedLines(raw_file)
             # get flight_id
             line = f.readline().strip()
             if len(line)>0:
@@ -281,15 +444,8 @@ def analyze_one_file(filename):
                     search_date = search_date.split(' ')[0]
             
             # Now get the flight list
-            block_list = get_block_list(f.readlines())
-            
-    #         num=1
-            for block in block_list:
-                flight_info = parse_block_info(block)
-                if flight_info != None:
-                    flight_info['id'] = flight_id
-                    flight_info['search_date'] = search_date
-                    flight_list.append(flight_info)
+            flight_list = list(iter_flight_info(f, flight_id, search_date))
+            h,fp = f.digests()
             
         t2 = datetime.datetime.now()
         tx = t2-t1
@@ -302,40 +458,275 @@ def analyze_one_file(filename):
         print("Error happened in analyzing %s,Error is: %s " %(filename, e))
 
     finally:
-        return flight_id,search_date,flight_list
+        if flight_id == None:
+            h = None
+            fp = None
+        return flight_id,search_date,flight_list,h,fp
+
+def analyze_one_segment(filename):
+    """
+    Analyze every page of a segment written by archive.SegmentWriter.
+    Return a list of tuples (flight_id, search_date, flight_list, page_hash,
+    fingerprint), see analyze_one_path. A page failed to parse gives an
+    empty flight_list and no hash, so its task is set to 0 and the other
+    pages are still stored. The list ends with (None, "None", [], None,
+    None) if the segment can't be read to the end.
+    """
+    global logger
+    
+    result_list = []
+    try:
+        t1 = datetime.datetime.now()
+        reader = archive.SegmentReader(filename)
+        try:
+            for record in reader:
+                search_date = record.search_date.split(' ')[0]
+                try:
+                    flight_list = parse_page_body(record.body, record.flight_id, search_date)
+                except Exception as e:
+                    logger.error("Error happened in analyzing flight id %s of %s,Error is: %s "
+                                 %(record.flight_id, filename, e))
+                    result_list.append((record.flight_id,search_date,[],None,None))
+                    continue
+                header = archive.make_header(record.flight_id,record.url,record.search_date,record.worker_num)
+                result_list.append((record.flight_id,search_date,flight_list,
+                                    page_hash(header,record.body),page_fingerprint(record.body)))
+        finally:
+            reader.close()
+        t2 = datetime.datetime.now()
+        tx = t2-t1
+        logger.info("[result] %s --- page number %d, cost seconds %d" %(filename,len(result_list),tx.seconds))
+    except Exception as e:
+        logger.error("Error happened in analyzing %s,Error is: %s " %(filename, e))
+        print("Error happened in analyzing %s,Error is: %s " %(filename, e))
+        result_list.append((None,"None",[],None,None))
+    
+    return result_list
 
-def analyze_results_to_db(dir_name='results'):
+def page_hash(header, body):
+    """
+    sha1 of a page, the same for a result file and for its record in a
+    segment: the header lines followed by the page text.
+    """
+    h = hashlib.sha1(header)
+    h.update(body)
+    return h.digest()
+
+def page_fingerprint(body):
+    """
+    sha1 of the page text only, the same for the page in memory, in a
+    segment or in a result file, which ends with a new line.
+    """
+    return hashlib.sha1(bytes(body).rstrip(b'\n')).digest()
+
+def analyze_one_path(filename):
+    """
+    Analyze a result file or a segment, return a list of tuples
+    (flight_id, search_date, flight_list, page_hash, fingerprint), see
+    analyze_one_file.
+    """
+    if filename.endswith('.seg'):
+        return analyze_one_segment(filename)
+    return [analyze_hashed_file(filename)]
+
+def archive_result(filename):
+    """
+    Keep an ingested result in g_archive_dir. A segment is moved there with
+    its index, a result file is appended to the archive segment of this
+    process and removed.
+    """
+    global archive_writer
+    
+    os.makedirs(g_archive_dir, exist_ok=True)
+    if filename.endswith('.seg'):
+        idx_name = archive.index_name(filename)
+        if os.path.exists(idx_name):
+            shutil.move(idx_name, os.path.join(g_archive_dir,os.path.basename(idx_name)))
+        shutil.move(filename, os.path.join(g_archive_dir,os.path.basename(filename)))
+    else:
+        if archive_writer == None:
+            archive_writer = archive.SegmentWriter(g_archive_dir, 'bak', max_age=3600)
+        archive_writer.append_result_file(filename)
+        os.remove(filename)
+
+def handle_analyzed_file(fdb, f, result_list):
+    """
+    Store the result of analyze_one_path for the file f in the database
+    and archive the file. A file failed to analyze stays.
+    """
+    failed = False
+    source = os.path.basename(f)
+    for flight_id,search_date,flight_list,h,fp in result_list:
+        if flight_id!=None:
+#             print_flight_list(fdb,flight_id,search_date,flight_list)
+            update_flight_list_into_db(fdb,flight_id,search_date,flight_list,2,h,source,fp)
+        else:
+            update_flight_list_into_db(fdb,flight_id,search_date,flight_list,0)
+            failed = True
+    if failed == False:
+        archive_result(f)
+
+def analyze_results_to_db(dir_name='results', processes=1, writer_num=1):
     """
     Analyze the result files stored in the dir directory.
     Store the results in the database.
+    processes: number of processes analyzing the files, 1 analyzes them
+    in this process.
+    writer_num: number of processes storing the results, 1 stores them
+    in this process. The files of one flight always go to the same writer
+    in the order of get_all_files.
     """
     file_list = get_all_files(dir_name)
+    analyze_file_list_to_db(file_list, processes, writer_num)
+
+def analyze_file_list_to_db(file_list, processes=1, writer_num=1, pool=None, fdb=None):
+    """
+    Analyze the files in file_list and store the results in the database,
+    see analyze_results_to_db.
+    pool, fdb: a process pool and a connected database to use instead of
+    creating them, they are left open.
+    """
+    if len(file_list) == 0:
+        return
+    
+    own_pool = False
+    if pool == None and processes > 1:
+        pool = mp.Pool(processes)
+        own_pool = True
+    if pool != None:
+        result_iter = pool.imap(analyze_one_path, file_list, chunksize=8)
+    else:
+        result_iter = map(analyze_one_path, file_list)
+    
+    writer_list = []
+    for i in range(writer_num if writer_num > 1 else 0):
+        write_q = mp.Queue(maxsize=256)
+        p = mp.Process(target=db_writer_exec, args=(write_q,))
+        p.start()
+        writer_list.append((p,write_q))
+    
+    own_fdb = False
+    try:
+        if len(writer_list) == 0 and fdb == None:
+            fdb = db.FlightPlanDatabase()
+            fdb.connectDB()
+            own_fdb = True
+        
+        for f,result_list in zip(file_list,result_iter):
+            if len(writer_list) == 0:
+                handle_analyzed_file(fdb,f,result_list)
+            else:
+                n = sort_fun(os.path.basename(f)) % len(writer_list)
+                writer_list[n][1].put((f,result_list))
+    finally:
+        if own_pool == True:
+            pool.close()
+            pool.join()
+        for p,write_q in writer_list:
+            write_q.put(None)
+        for p,write_q in writer_list:
+            p.join()
+        if own_fdb == True:
+            fdb.disconnectDB()
+
+def db_writer_exec(write_q):
+    """
+    Writer process of analyze_results_to_db, store every analyzed file
+    coming from write_q until None is received.
+    """
     fdb = db.FlightPlanDatabase()
     fdb.connectDB()
     try:
-        for f in file_list:
-            flight_id,search_date,flight_list = analyze_one_file(f)
-            if flight_id!=None:
-#                 print_flight_list(fdb,flight_id,search_date,flight_list)
-                update_flight_list_into_db(fdb,flight_id,search_date,flight_list,2)
-                cmd="mv "+f +" "+"backup/"
-                print(cmd)
-                os.system(cmd)
-            else:
-                update_flight_list_into_db(fdb,flight_id,search_date,flight_list,0)
-            
+        while True:
+            item = write_q.get()
+            if item == None:
+                break
+            f,result_list = item
+            handle_analyzed_file(fdb,f,result_list)
     finally:
+        if archive_writer != None:
+            archive_writer.close()
         fdb.disconnectDB()
 
-def schedule_results_analyze(dir_name='results', interval_time=60):
+def schedule_results_analyze(dir_name='results', interval_time=60, processes=1, writer_num=1):
     """
     This function start a task to analyze the results in the dir_name
     by invoking the analyze_results at a interval_time.
     interval_time --- how many seconds the function start a task
+    processes, writer_num --- see analyze_results_to_db
     """
     while True:
         time.sleep(interval_time)
-        analyze_results_to_db(dir_name)
+        analyze_results_to_db(dir_name, processes, writer_num)
+                
+def pipeline_writer_exec(page_q):
+    """
+    DB writer of the direct pipeline mode: store the fares the workers
+    parsed in memory, coming from page_q as (flight_id, search_date,
+    flight_list, fingerprint), until None is received.
+    """
+    fdb = db.FlightPlanDatabase()
+    fdb.connectDB()
+    try:
+        while True:
+            try:
+                item = page_q.get(timeout=5)
+            except queue.Empty:
+                fdb.flush_status_in_flight_price_query_task_tbl(False)
+                continue
+            if item == None:
+                break
+            flight_id,search_date,flight_list,fp = item
+            update_flight_list_into_db(fdb,flight_id,search_date,flight_list,2,fingerprint=fp)
+            logger.info("[result] pipeline [%s] --- result number %d" %(flight_id,len(flight_list)))
+    finally:
+        fdb.disconnectDB()
+
+def ingest_results(dir_name='results', processes=1, batch_delay=1):
+    """
+    Ingestion daemon: analyze the result files and segments as soon as
+    Recorder.finish or SegmentWriter.seal renames them into dir_name,
+    instead of rescanning the directory.
+    The directory is scanned once at start, after that the pending files
+    come from inotify (or from a polling fallback).
+    A file failed to analyze stays in dir_name and is tried again when the
+    daemon restarts.
+    The archive segment is sealed when idle once it is due, and on exit,
+    SIGTERM included.
+    batch_delay --- seconds to wait for more files before a batch starts
+    """
+    pending = watcher.PendingFiles(dir_name, result_suffix)
+    pool = None
+    if processes > 1:
+        pool = mp.Pool(processes)
+    fdb = db.FlightPlanDatabase()
+    fdb.connectDB()
+    # SIGTERM must still run the finally below, the source files of the
+    # open archive segment are already removed
+    signal.signal(signal.SIGTERM, exit_on_signal)
+    try:
+        while True:
+            if pending.wait(60) == 0:
+                fdb.flush_status_in_flight_price_query_task_tbl()
+                if archive_writer != None:
+                    archive_writer.seal_if_due()
+                continue
+            time.sleep(batch_delay)
+            pending.wait(0)
+            file_list = pending.take(lambda name:(sort_fun(os.path.basename(name)),name))
+            analyze_file_list_to_db(file_list, pool=pool, fdb=fdb)
+            fdb.flush_status_in_flight_price_query_task_tbl()
+    finally:
+        pending.close()
+        if archive_writer != None:
+            archive_writer.close()
+        if pool != None:
+            pool.close()
+            pool.join()
+        fdb.disconnectDB()
+
+def exit_on_signal(signum, frame):
+    sys.exit(0)
                 
 def main():
     global logger
@@ -363,10 +754,40 @@ def main():
     logger.setLevel('INFO')
     
     analyze_results_to_db()
+    if archive_writer != None:
+        archive_writer.close()
     
 #     logger_handle.emit()
     logger_handle.close()
 
+def test_compare_parser(dir_name='backup'):
+    """
+    Check iter_flight_info gives the same flight list as get_block_list and
+    parse_block_info on every result file in dir_name.
+    """
+    file_num = 0
+    diff_num = 0
+    for filename in get_all_files(dir_name):
+        with open(filename,'rb') as f:
+            lines = f.readlines()[3:]
+        try:
+            old_list = [parse_block_info(b) for b in get_block_list(lines)]
+            old_list = [x for x in old_list if x != None]
+        except Exception as e:
+            old_list = type(e)
+        try:
+            new_list = list(iter_flight_info(iter(lines)))
+            for x in new_list:
+                del x['id']
+                del x['search_date']
+        except Exception as e:
+            new_list = type(e)
+        file_num += 1
+        if old_list != new_list and not (type(old_list)==type and type(new_list)==type):
+            diff_num += 1
+            print("%s is different" %filename)
+    print("compared %d files, %d different" %(file_num,diff_num))
+
 def test():
     flight_tup = analyze_one_file('results/res_20160602_168183.txt')
     if flight_tup != None:
@@ -0,0 +1,152 @@
+---- 
+---- Compare the plans of the old function-based views with the join-based
+---- views in views.sql on a generated dataset.
+---- Run with psql against a database where functions.sql has been loaded:
+----     psql -d flight_db -f script/benchmark.sql
+---- Everything is created in the bench schema, which is dropped at the end;
+---- the objects are qualified with bench so nothing of public is touched.
+---- 
+
+\set airlines 30
+\set days 90
+\set search_days 30
+\set fares 10
+
+DROP SCHEMA IF EXISTS bench CASCADE;
+CREATE SCHEMA bench;
+---- Only for the get_*_name functions of the old views, which read the
+---- unqualified tables; everything below is qualified with bench.
+SET search_path = bench, public;
+
+CREATE TABLE bench.cabinclass (LIKE public.cabinclass INCLUDING ALL);
+CREATE TABLE bench.city (LIKE public.city INCLUDING ALL);
+CREATE TABLE bench.airline_company (LIKE public.airline_company INCLUDING ALL);
+CREATE TABLE bench.trip (LIKE public.trip INCLUDING ALL);
+CREATE TABLE bench.airline (LIKE public.airline INCLUDING ALL);
+CREATE TABLE bench.flight (LIKE public.flight INCLUDING ALL);
+CREATE TABLE bench.flight_price (LIKE public.flight_price INCLUDING DEFAULTS);
+CREATE TABLE bench.flight_price_query_task (LIKE public.flight_price_query_task INCLUDING ALL);
+
+INSERT INTO bench.cabinclass SELECT * FROM public.cabinclass;
+INSERT INTO bench.city SELECT * FROM public.city;
+INSERT INTO bench.trip SELECT * FROM public.trip;
+INSERT INTO bench.airline_company SELECT i, 'company '||i FROM generate_series(1,40) i;
+INSERT INTO bench.airline SELECT i, 1+i%4, 5+i%5 FROM generate_series(1,:airlines) i;
+
+INSERT INTO bench.flight (id,airline_id,trip,start_date,stay_days,adults,children,children_age,cabinclass,create_date)
+SELECT row_number() over (), a, 1, current_date+d, 0, 1, 0, '{}', 3, current_date
+FROM generate_series(1,:airlines) a, generate_series(1,:days) d;
+
+INSERT INTO bench.flight_price (flight_id,price,company_id,departure_time,arrival_time,span_days,duration,stop,stop_info,search_date)
+SELECT f.id, (300+random()*900)::numeric::money, 1+(random()*39)::int,
+       '10:05', '21:35', 0, '13h 30m', '1 stop', '1h 15m in HKG',
+       current_date-s
+FROM bench.flight f, generate_series(0,:search_days-1) s, generate_series(1,:fares) n;
+
+ANALYZE;
+
+---- The old views, calling one function per row and column
+CREATE VIEW bench.old_flight_view AS
+SELECT flight.id, get_city_name(airline.from_city) as from, get_city_name(airline.to_city) as to,
+       get_trip_name(trip) as trip, start_date, stay_days, adults, children, children_age as age,
+       get_cabinclass_name(flight.cabinclass) as class, create_date
+FROM bench.flight,bench.airline WHERE flight.airline_id = airline.id;
+
+CREATE VIEW bench.old_flight_price_view AS
+SELECT flight_id, price, get_company_name(company_id) as company, departure_time, arrival_time,
+       span_days, duration, stop, stop_info, rate, search_date as date
+FROM bench.flight_price;
+
+CREATE VIEW bench.old_flight_detail_price_view AS
+SELECT old_flight_view.from, old_flight_view.to, trip, start_date, stay_days, departure_time,
+       arrival_time, span_days, duration, stop, stop_info, rate, adults, class, price, company,
+       date as search_date
+FROM bench.old_flight_view JOIN bench.old_flight_price_view ON id=flight_id;
+
+---- The new views queried below, a copy of views.sql in the bench schema.
+---- views.sql itself must not be sourced here: its DROP VIEW would find
+---- the views of public, the bench schema has none yet.
+CREATE VIEW bench.flight_view AS 
+SELECT 
+    flight.id, 
+    fc.name as from,
+    tc.name as to,
+    trip.name as trip,
+    start_date,
+    stay_days,
+    adults,
+    children,
+    children_age as age,
+    cabinclass.name as class,
+    create_date
+FROM bench.flight
+JOIN bench.airline ON flight.airline_id = airline.id
+LEFT JOIN bench.city fc ON fc.id = airline.from_city
+LEFT JOIN bench.city tc ON tc.id = airline.to_city
+LEFT JOIN bench.trip ON trip.id = flight.trip
+LEFT JOIN bench.cabinclass ON cabinclass.id = flight.cabinclass;
+
+
+CREATE VIEW bench.flight_price_view AS
+SELECT
+    flight_id,
+    price,
+    airline_company.name as company,
+    departure_time,
+    arrival_time,
+    span_days,
+    duration,
+    stop,
+    stop_info,
+    rate,
+    search_date as date
+FROM bench.flight_price
+LEFT JOIN bench.airline_company ON airline_company.id = flight_price.company_id;
+
+CREATE VIEW bench.flight_detail_price_view AS
+SELECT 
+    flight_view.from,
+    flight_view.to,
+    trip,
+    start_date,
+    stay_days,
+    departure_time,
+    arrival_time,
+    span_days,
+    duration,
+    stop,
+    stop_info,
+    rate,
+    adults,
+    class,
+    price,
+    company,
+    date as search_date 
+FROM bench.flight_view JOIN bench.flight_price_view ON id=flight_id;
+
+\echo '==== old flight_detail_price_view, last 7 search days ===='
+EXPLAIN (ANALYZE, BUFFERS)
+SELECT * FROM bench.old_flight_detail_price_view WHERE search_date > current_date-7;
+
+\echo '==== new flight_detail_price_view, last 7 search days, no index ===='
+EXPLAIN (ANALYZE, BUFFERS)
+SELECT * FROM bench.flight_detail_price_view WHERE search_date > current_date-7;
+
+---- The indexes of indexes.sql used by the view, on the bench tables
+CREATE INDEX ON bench.flight(start_date);
+CREATE INDEX ON bench.flight(airline_id, start_date);
+CREATE INDEX ON bench.flight_price(flight_id, search_date);
+ANALYZE;
+
+\echo '==== new flight_detail_price_view, one flight, with indexes ===='
+EXPLAIN (ANALYZE, BUFFERS)
+SELECT * FROM bench.flight_detail_price_view
+WHERE search_date > current_date-7 AND start_date = current_date+30;
+
+\echo '==== old flight_detail_price_view, one flight ===='
+EXPLAIN (ANALYZE, BUFFERS)
+SELECT * FROM bench.old_flight_detail_price_view
+WHERE search_date > current_date-7 AND start_date = current_date+30;
+
+RESET search_path;
+DROP SCHEMA bench CASCADE;
@@ -54,7 +54,8 @@ DECLARE
 BEGIN
     SELECT id into company_id from airline_company where name=n;
     IF NOT FOUND THEN
-        INSERT INTO airline_company VALUES(nextval('airline_company_id'),n);
+        INSERT INTO airline_company VALUES(nextval('airline_company_id'),n)
+        ON CONFLICT (name) DO NOTHING;
     END IF;
     SELECT id into company_id from airline_company where name=n;
     return company_id;
@@ -64,76 +65,197 @@ $$ LANGUAGE PLPGSQL;
 CREATE OR REPLACE FUNCTION create_today_task() returns int8 AS
 $$
     DELETE FROM flight_price_query_task where execute_date<=current_date;
-    insert into flight_price_query_task select id,0,current_date from flight where start_date>current_date;
+    insert into flight_price_query_task select id,0,current_date from flight where start_date>current_date
+        on conflict (flight_id,execute_date) do nothing;
     SELECT count(*) from flight_price_query_task where execute_date=current_date;
 $$ LANGUAGE SQL;
 
 
 ---- Function: create_one_way_airlines_schedule
--- range indicates what is the last start_date
+-- Add the oneway flights of every airline departing on start_date,
+-- the airlines which already have one are skipped.
 CREATE OR REPLACE FUNCTION create_one_way_airlines(start_date date) returns int8 AS
+$$
+    WITH n AS (
+        INSERT INTO flight
+        SELECT nextval('flight_id'), a.id, 1, $1, 0, 1, 0, '{}', 3, current_date
+        FROM airline a
+        WHERE NOT EXISTS (SELECT 1 FROM flight f
+                          WHERE f.airline_id=a.id AND f.start_date=$1 AND f.trip=1)
+        RETURNING 1)
+    SELECT count(*) FROM n;
+$$ LANGUAGE SQL;
+
+---- Function: create_roundtrip_arilines
+-- Add the roundtrip flights of every airline departing on start_date
+-- with stay_days from 1 to stay_days_range, existing ones are skipped.
+CREATE OR REPLACE FUNCTION create_roundtrip_airlines(start_date date,stay_days_range int4) returns int8 AS
+$$
+    WITH n AS (
+        INSERT INTO flight
+        SELECT nextval('flight_id'), a.id, 2, $1, s.stay_days, 1, 0, '{}', 3, current_date
+        FROM airline a
+        CROSS JOIN generate_series(1,$2) AS s(stay_days)
+        WHERE NOT EXISTS (SELECT 1 FROM flight f
+                          WHERE f.airline_id=a.id AND f.start_date=$1
+                            AND f.trip=2 AND f.stay_days=s.stay_days)
+        RETURNING 1)
+    SELECT count(*) FROM n;
+$$ LANGUAGE SQL;
+
+---- The request url of a flight is built from the city url_name and the
+---- cabinclass name, reset it when they change so fill_request_urls
+---- creates it again.
+CREATE OR REPLACE FUNCTION reset_city_request_url() returns trigger AS
+$$
+BEGIN
+    UPDATE flight SET request_url = NULL
+    FROM airline
+    WHERE flight.airline_id = airline.id
+      AND (airline.from_city = NEW.id OR airline.to_city = NEW.id);
+    RETURN NEW;
+END;
+$$ LANGUAGE PLPGSQL;
+
+CREATE OR REPLACE FUNCTION reset_cabinclass_request_url() returns trigger AS
+$$
+BEGIN
+    UPDATE flight SET request_url = NULL WHERE cabinclass = NEW.id;
+    RETURN NEW;
+END;
+$$ LANGUAGE PLPGSQL;
+
+DROP TRIGGER IF EXISTS city_request_url_trigger ON city;
+CREATE TRIGGER city_request_url_trigger
+    AFTER UPDATE OF url_name ON city
+    FOR EACH ROW WHEN (OLD.url_name IS DISTINCT FROM NEW.url_name)
+    EXECUTE PROCEDURE reset_city_request_url();
+
+DROP TRIGGER IF EXISTS cabinclass_request_url_trigger ON cabinclass;
+CREATE TRIGGER cabinclass_request_url_trigger
+    AFTER UPDATE OF name ON cabinclass
+    FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+    EXECUTE PROCEDURE reset_cabinclass_request_url();
+
+---- Function: create the monthly flight_price partitions covering
+---- [from_date, to_date], the existing ones are skipped. The rows of the
+---- month already in the default partition are moved into the new one
+---- before it is attached, PARTITION OF would fail on them.
+CREATE OR REPLACE FUNCTION create_flight_price_partitions(from_date date, to_date date) returns int4 AS
 $$
 DECLARE
-    airline_id int4;
-    stay_days int4;
+    m date;
+    part_name text;
     num int4;
 BEGIN
     num := 0;
-    for airline_id in SELECT id from airline 
-    LOOP --- loop airline_id
-        RAISE NOTICE 'airline_id[%],trip[oneway],start_date[%]', airline_id,start_date;
-        INSERT INTO flight VALUES (
-        nextval('flight_id'),
-        airline_id,
-        1,  ---oneway
-        start_date,
-        0,
-        1,
-        0,
-        '{}',
-        3,  ---economy
-        current_date);
-        num = num+1;
+    m := date_trunc('month', from_date)::date;
+    WHILE m <= to_date LOOP
+        part_name := 'flight_price_' || to_char(m, 'YYYYMM');
+        IF to_regclass(part_name) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I (LIKE flight_price INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+                           part_name);
+            EXECUTE format('WITH moved AS (DELETE FROM flight_price_default
+                                           WHERE search_date >= %L AND search_date < %L RETURNING *)
+                            INSERT INTO %I SELECT * FROM moved',
+                           m, (m + interval '1 month')::date, part_name);
+            EXECUTE format('ALTER TABLE flight_price ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                           part_name, m, (m + interval '1 month')::date);
+            num := num + 1;
+        END IF;
+        m := (m + interval '1 month')::date;
     END LOOP;
     RETURN num;
 END;
-$$LANGUAGE PLPGSQL;
+$$ LANGUAGE PLPGSQL;
 
----- Function: create_roundtrip_arilines
--- range is the start_date range. 
--- stay_days_range is for the range of stay_days from 1 to this value;
-CREATE OR REPLACE FUNCTION create_roundtrip_airlines(start_date date,stay_days_range int4) returns int8 AS
+---- Function: detach the monthly flight_price partitions which end before
+---- before_date and move them into the flight_archive schema. An archived
+---- month is dropped with DROP TABLE, no DELETE on flight_price is needed.
+CREATE OR REPLACE FUNCTION detach_flight_price_partitions(before_date date) returns SETOF text AS
 $$
 DECLARE
-    airline_id int4;
-    stay_days int4;
-    num int4;
+    part_name text;
 BEGIN
-    num := 0;
-    for airline_id in SELECT id from airline 
-    LOOP --- loop airline_id
-        stay_days :=1;
-        LOOP --- loop stay days
-            RAISE NOTICE 'airline_id[%],trip[roundtrip],start_date[%],stay_days[%]', airline_id,start_date,stay_days;
-            INSERT INTO flight VALUES (
-            nextval('flight_id'),
-            airline_id,
-            2,  ---roundtrip
-            start_date,
-            stay_days,
-            1,
-            0,
-            '{}',
-            3,  ---economy
-            current_date);
-            num = num+1;
-            stay_days = stay_days+1;
-            IF stay_days > stay_days_range THEN
-                EXIT;
-            END IF;
-        END LOOP;
+    FOR part_name IN
+        SELECT c.relname
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'flight_price'::regclass
+          AND c.relname ~ '^flight_price_[0-9]{6}$'
+          AND to_date(substr(c.relname, 14), 'YYYYMM') + interval '1 month' <= before_date
+        ORDER BY c.relname
+    LOOP
+        EXECUTE format('ALTER TABLE flight_price DETACH PARTITION %I', part_name);
+        EXECUTE format('ALTER TABLE %I SET SCHEMA flight_archive', part_name);
+        RETURN NEXT part_name;
     END LOOP;
-    RETURN num;
 END;
-$$LANGUAGE PLPGSQL;
+$$ LANGUAGE PLPGSQL;
 
+---- Function: priority scheduler, score today's tasks not started yet.
+---- The priority of a flight is the sum of
+----     w_departure / (1 + days to departure / 7)
+----     w_volatility * coefficient of variation of its daily lowest price in
+----                    the last window_days days, divided by 0.1, at most 1
+----                    (1 for a flight never crawled). The days its page
+----                    was unchanged, from unchanged_since to last_seen in
+----                    flight_page_fingerprint, have no rows of their own and
+----                    count with the prices of unchanged_since.
+----     w_stale * days since its last crawl / max_skip_days, at most 1
+---- The last crawl is the latest of its last prices and of the last page in
+---- flight_page_fingerprint. A task scored below skip_score is set to status 3
+---- (skipped) unless the flight was not crawled for max_skip_days days.
+---- Return the number of scored and skipped tasks.
+CREATE OR REPLACE FUNCTION score_query_tasks(w_departure float8, w_volatility float8, w_stale float8,
+                                             window_days int4, skip_score float8, max_skip_days int4)
+returns TABLE(task_num int4, skip_num int4) AS
+$$
+BEGIN
+    RETURN QUERY
+    WITH day_price AS (
+        SELECT p.flight_id, p.search_date, min(p.price::numeric) AS price
+        FROM flight_price p
+        WHERE p.search_date >= current_date - window_days
+        GROUP BY p.flight_id, p.search_date
+    ), unchanged_price AS (
+        SELECT fp.flight_id, g.day::date AS search_date, min(p.price::numeric) AS price
+        FROM flight_page_fingerprint fp
+        JOIN flight_price p ON p.flight_id = fp.flight_id AND p.search_date = fp.unchanged_since
+        CROSS JOIN generate_series(greatest(fp.unchanged_since + 1, current_date - window_days),
+                                   fp.last_seen, interval '1 day') AS g(day)
+        GROUP BY fp.flight_id, g.day
+    ), all_day_price AS (
+        SELECT a.flight_id, a.search_date, min(a.price) AS price
+        FROM (SELECT * FROM day_price UNION ALL SELECT * FROM unchanged_price) a
+        GROUP BY a.flight_id, a.search_date
+    ), price_stat AS (
+        SELECT d.flight_id,
+               count(*) AS day_num,
+               coalesce(stddev_samp(d.price) / nullif(avg(d.price), 0), 0)::float8 AS cv,
+               max(d.search_date) AS last_date
+        FROM all_day_price d
+        GROUP BY d.flight_id
+    ), score AS (
+        SELECT t.flight_id,
+               w_departure / (1 + greatest(f.start_date - current_date, 0) / 7.0)
+               + w_volatility * CASE WHEN ps.flight_id IS NULL AND fp.flight_id IS NULL THEN 1.0
+                                     ELSE least(coalesce(ps.cv, 0) / 0.1, 1.0) END
+               + w_stale * least(coalesce(current_date - greatest(ps.last_date, fp.last_seen), max_skip_days)::float8
+                                 / greatest(max_skip_days, 1), 1.0) AS priority,
+               coalesce(current_date - greatest(ps.last_date, fp.last_seen), max_skip_days) AS stale_days
+        FROM flight_price_query_task t
+        JOIN flight f ON f.id = t.flight_id
+        LEFT JOIN price_stat ps ON ps.flight_id = t.flight_id
+        LEFT JOIN flight_page_fingerprint fp ON fp.flight_id = t.flight_id
+        WHERE t.execute_date = current_date AND t.status = 0
+    ), scored AS (
+        UPDATE flight_price_query_task t
+        SET priority = s.priority,
+            status = CASE WHEN s.priority < skip_score AND s.stale_days < max_skip_days THEN 3 ELSE 0 END
+        FROM score s
+        WHERE t.flight_id = s.flight_id AND t.execute_date = current_date
+        RETURNING t.status
+    )
+    SELECT count(*)::int4, (count(*) FILTER (WHERE scored.status = 3))::int4 FROM scored;
+END;
+$$ LANGUAGE PLPGSQL;
@@ -0,0 +1,19 @@
+---- 
+---- CREATE INDEXES
+---- Run after table.sql, every statement can be run again safely.
+---- 
+
+---- get_today_task_id / claim_tasks: today's tasks by status in priority order
+DROP INDEX IF EXISTS flight_price_query_task_date_status_idx;
+CREATE INDEX IF NOT EXISTS flight_price_query_task_priority_idx
+    ON flight_price_query_task(execute_date, status, priority DESC, flight_id);
+
+---- create_today_task and the views filtering on the departure date
+CREATE INDEX IF NOT EXISTS flight_start_date_idx ON flight(start_date);
+
+---- add_one_group_flight_schedule looks for the existing flight of an airline and day
+CREATE INDEX IF NOT EXISTS flight_airline_start_date_idx ON flight(airline_id, start_date);
+
+---- flight_detail_price_view joins flight_price on flight_id and range scans
+---- by search_date through the unique key, which starts with (flight_id, search_date)
+DROP INDEX IF EXISTS flight_price_flight_date_idx;
@@ -7,6 +7,8 @@ drop table if exists flight cascade;
 drop table if exists trip cascade;
 drop table if exists flight_price cascade;
 drop table if exists flight_price_query_task;
+drop table if exists ingest_manifest;
+drop table if exists flight_page_fingerprint;
 
 DROP SEQUENCE IF EXISTS airline_id;
 DROP SEQUENCE IF EXISTS airline_company_id;
@@ -42,7 +44,7 @@ url_name text);
 ---- airline_company
 CREATE TABLE airline_company(
 id int4 primary key,
-name varchar);
+name varchar unique);
 
 
 ---- trip,  
@@ -69,14 +71,20 @@ adults int4,
 children int4,
 children_age int2[],
 cabinclass int4 default 3,  ---references cabinclass table
-create_date date);
+create_date date,
+request_url text);  ---filled by FlightPlanDatabase.fill_request_urls
 
 ---- This table is used by the workers to record the task is finshed or not.
 ---- Also the task manager can see which task are waiting to be done.
 CREATE TABLE flight_price_query_task(
 flight_id int4,  --- references flight(id)
-status int4, ---- 0: not finished. 1: finished
-execute_date date   ---- date to execute the task
+status int4, ---- 0: not started. 1: running. 2: finished. 3: skipped by the scheduler
+execute_date date,   ---- date to execute the task
+node_id varchar,   ---- host which claimed the task
+worker_id int4,    ---- worker number on that host
+lease_expire timestamp,   ---- a running task can be claimed again after it
+priority float8,   ---- tasks are executed by priority, see score_query_tasks
+primary key (flight_id, execute_date)   ---- one task per flight and day, see create_today_task
 );
 
 
@@ -95,6 +103,54 @@ stop text,    --- stop times in the flight duration,default is 1 which means fli
 stop_info text, --- detail stop information
 rate float,
 search_date date --- date to get it
+) PARTITION BY RANGE (search_date);
+
+---- One row per fare of a search day, the ingest is an upsert on this key.
+---- The partition key search_date must be part of it.
+ALTER TABLE flight_price ADD CONSTRAINT flight_price_natural_key
+    UNIQUE (flight_id, search_date, company_id, departure_time, arrival_time, span_days, stop, stop_info);
+
+---- flight_price is partitioned by month of search_date, the partitions
+---- flight_price_YYYYMM are created ahead by create_flight_price_partitions
+---- and old ones are moved to flight_archive by detach_flight_price_partitions.
+---- The default partition takes the rows no monthly partition exists for.
+CREATE TABLE flight_price_default PARTITION OF flight_price DEFAULT;
+
+---- This month and the next one, so no row goes to the default partition
+---- before main first runs create_flight_price_partitions.
+DO $$
+DECLARE
+    m date := date_trunc('month', current_date)::date;
+BEGIN
+    FOR i IN 0..1 LOOP
+        EXECUTE format('CREATE TABLE %I PARTITION OF flight_price FOR VALUES FROM (%L) TO (%L)',
+                       'flight_price_' || to_char(m, 'YYYYMM'), m, (m + interval '1 month')::date);
+        m := (m + interval '1 month')::date;
+    END LOOP;
+END;
+$$;
+
+CREATE SCHEMA IF NOT EXISTS flight_archive;
+
+---- ingest_manifest
+---- Pages already stored into flight_price, recorded in the same transaction
+---- as their fares so a page ingested again after a crash is skipped.
+CREATE TABLE ingest_manifest(
+page_hash bytea PRIMARY KEY,  --- sha1 of the page header and text
+source varchar,   --- result file or segment the page came from
+flight_id int4,
+search_date date,
+row_num int4,   --- number of fares of the page
+ingest_time timestamp DEFAULT now()
 );
 
-
+---- flight_page_fingerprint
+---- sha1 of the last result page of every flight. A page crawled again with
+---- the same fingerprint is not stored: the fares of the flight are the ones
+---- of search_date unchanged_since, see FlightPlanDatabase.update_page_fingerprint.
+CREATE TABLE flight_page_fingerprint(
+flight_id int4 primary key references flight(id) on delete cascade,
+fingerprint bytea,
+unchanged_since date,   --- search_date the page got this fingerprint
+last_seen date   --- search_date the page was crawled last
+);
@@ -0,0 +1,82 @@
+---- 
+---- Upgrade an existing database created by an older table.sql.
+---- Run the sections newer than the database once, in order.
+---- 
+
+---- Task lease columns used by FlightPlanDatabase.claim_tasks
+ALTER TABLE flight_price_query_task ADD COLUMN node_id varchar;
+ALTER TABLE flight_price_query_task ADD COLUMN worker_id int4;
+ALTER TABLE flight_price_query_task ADD COLUMN lease_expire timestamp;
+
+---- Precomputed request url, see FlightPlanDatabase.fill_request_urls
+---- and the reset triggers in functions.sql
+ALTER TABLE flight ADD COLUMN request_url text;
+
+---- One row per airline company name, needed by the ON CONFLICT insert in
+---- FlightPlanDatabase.get_company_id_dict. Remove duplicated names first.
+ALTER TABLE airline_company ADD CONSTRAINT airline_company_name_key UNIQUE (name);
+
+---- Join-based views and the indexes: run views.sql and indexes.sql again.
+
+---- Partition flight_price by search_date (PostgreSQL 11 or later).
+---- Load functions.sql first for create_flight_price_partitions.
+BEGIN;
+ALTER TABLE flight_price RENAME TO flight_price_heap;
+CREATE TABLE flight_price (LIKE flight_price_heap INCLUDING DEFAULTS) PARTITION BY RANGE (search_date);
+CREATE TABLE flight_price_default PARTITION OF flight_price DEFAULT;
+CREATE SCHEMA IF NOT EXISTS flight_archive;
+SELECT create_flight_price_partitions(
+    coalesce((SELECT min(search_date) FROM flight_price_heap), current_date),
+    (current_date + interval '2 month')::date);
+INSERT INTO flight_price SELECT * FROM flight_price_heap;
+DROP TABLE flight_price_heap CASCADE;
+COMMIT;
+---- The views depending on flight_price were dropped, run views.sql and indexes.sql again.
+
+---- Natural key of flight_price for the ON CONFLICT ingest and the
+---- ingest_manifest table. Remove the duplicated fares first.
+BEGIN;
+DELETE FROM flight_price p USING (
+    SELECT ctid, tableoid, row_number() OVER (
+        PARTITION BY flight_id, search_date, company_id, departure_time, arrival_time, span_days, stop, stop_info
+        ORDER BY ctid) AS n
+    FROM flight_price) d
+WHERE p.tableoid = d.tableoid AND p.ctid = d.ctid AND d.n > 1;
+ALTER TABLE flight_price ADD CONSTRAINT flight_price_natural_key
+    UNIQUE (flight_id, search_date, company_id, departure_time, arrival_time, span_days, stop, stop_info);
+CREATE TABLE ingest_manifest(
+page_hash bytea PRIMARY KEY,
+source varchar,
+flight_id int4,
+search_date date,
+row_num int4,
+ingest_time timestamp DEFAULT now()
+);
+COMMIT;
+
+---- Fingerprint of the last result page of every flight
+CREATE TABLE flight_page_fingerprint(
+flight_id int4 primary key references flight(id) on delete cascade,
+fingerprint bytea,
+unchanged_since date,
+last_seen date
+);
+
+---- Task priority of the scheduler, load functions.sql for score_query_tasks
+---- and run indexes.sql again.
+ALTER TABLE flight_price_query_task ADD COLUMN priority float8;
+
+---- One task per flight and day, several hosts can create today's tasks
+---- together. Remove the duplicated tasks first.
+BEGIN;
+DELETE FROM flight_price_query_task t USING (
+    SELECT ctid, row_number() OVER (
+        PARTITION BY flight_id, execute_date ORDER BY status DESC, ctid) AS n
+    FROM flight_price_query_task) d
+WHERE t.ctid = d.ctid AND d.n > 1;
+ALTER TABLE flight_price_query_task ADD PRIMARY KEY (flight_id, execute_date);
+COMMIT;
+
+---- The unique key of flight_price starts with (flight_id, search_date), the
+---- separate index on these columns only slows down the inserts.
+DROP INDEX IF EXISTS flight_price_flight_date_idx;
@@ -1,56 +1,71 @@
 ---- 
 ---- CREATE VIEWS
 ---- 
+---- The views join the reference tables instead of calling the
+---- get_*_name functions, which ran one lookup query per row and column.
+---- LEFT JOINs keep the rows whose reference is missing, like the
+---- functions returning NULL did.
 DROP VIEW IF EXISTS airline_view;
 CREATE OR REPLACE VIEW airline_view AS
 SELECT
-    id,
-    get_city_name(from_city) as from_city,
-    get_city_name(to_city) as to_city
-FROM airline;
+    airline.id,
+    fc.name as from_city,
+    tc.name as to_city
+FROM airline
+LEFT JOIN city fc ON fc.id = airline.from_city
+LEFT JOIN city tc ON tc.id = airline.to_city;
 
-DROP VIEW IF EXISTS flight_view;
+DROP VIEW IF EXISTS flight_view CASCADE;
 CREATE OR REPLACE VIEW flight_view AS 
 SELECT 
     flight.id, 
-    get_city_name(airline.from_city) as from,
-    get_city_name(airline.to_city) as to,
-    get_trip_name(trip) as trip,
+    fc.name as from,
+    tc.name as to,
+    trip.name as trip,
     start_date,
     stay_days,
     adults,
     children,
     children_age as age,
-    get_cabinclass_name(flight.cabinclass) as class,
+    cabinclass.name as class,
     create_date
-FROM flight,airline
-WHERE flight.airline_id = airline.id;
+FROM flight
+JOIN airline ON flight.airline_id = airline.id
+LEFT JOIN city fc ON fc.id = airline.from_city
+LEFT JOIN city tc ON tc.id = airline.to_city
+LEFT JOIN trip ON trip.id = flight.trip
+LEFT JOIN cabinclass ON cabinclass.id = flight.cabinclass;
 
 
 DROP VIEW IF EXISTS flight_url_view;
 CREATE OR REPLACE VIEW flight_url_view AS 
 SELECT 
     flight.id, 
-    get_city_url_name(airline.from_city) as from,
-    get_city_url_name(airline.to_city) as to,
-    get_trip_name(trip) as trip,
+    fc.url_name as from,
+    tc.url_name as to,
+    trip.name as trip,
     start_date,
     stay_days,
     adults,
     children,
     children_age as age,
-    get_cabinclass_name(flight.cabinclass) as class,
-    create_date
-FROM flight,airline
-WHERE flight.airline_id = airline.id;
+    cabinclass.name as class,
+    create_date,
+    request_url
+FROM flight
+JOIN airline ON flight.airline_id = airline.id
+LEFT JOIN city fc ON fc.id = airline.from_city
+LEFT JOIN city tc ON tc.id = airline.to_city
+LEFT JOIN trip ON trip.id = flight.trip
+LEFT JOIN cabinclass ON cabinclass.id = flight.cabinclass;
 
 
-DROP VIEW IF EXISTS flight_price_view;
+DROP VIEW IF EXISTS flight_price_view CASCADE;
 CREATE OR REPLACE VIEW flight_price_view AS
 SELECT
     flight_id,
     price,
-    get_company_name(company_id) as company,
+    airline_company.name as company,
     departure_time,
     arrival_time,
     span_days,
@@ -59,7 +74,8 @@ SELECT
     stop_info,
     rate,
     search_date as date
-FROM flight_price;
+FROM flight_price
+LEFT JOIN airline_company ON airline_company.id = flight_price.company_id;
 
 CREATE OR REPLACE VIEW flight_detail_price_view AS
 SELECT 
@@ -27,29 +27,66 @@ class ExpediaReqURL():
         self.filename=filename
         
     def createURL(self,**fly):
+        return self.createURLList([fly])[0]
+    
+    def createURLList(self,flight_list):
+        """
+        Create the urls of all flights in flight_list in one call.
+        Every flight is a dict with the keys used by createURL. The legs,
+        dates and passenger/option parts are built once and shared by all
+        flights using them, so a whole day of flights costs little more
+        than a dict lookup per flight.
+        Return a list of url in the same order as flight_list.
+        """
         http_head="https://www.expedia.com.au/Flights-Search?mode=search"
         
-        from_city_name = fly["from"].lower()
-        to_city_name=fly["to"].lower()
-        
-        departure_date=fly['start_date'].strftime("%d-%m-%Y")
+        city_cache = dict()
+        date_cache = dict()
+        tail_cache = dict()
+        url_list = []
         
-        
-        leg1=self.createleg(from_city_name,
-                            to_city_name,
-                            departure_date)
-        trip=fly["trip"]
-        if trip=="roundtrip":
-            return_date=fly['return_date'].strftime("%d-%m-%Y")
-            leg2=self.createleg(to_city_name,
-                                from_city_name,
-                                return_date)
-        else:
-            leg2=""
+        for fly in flight_list:
+            from_city = fly["from"]
+            if from_city not in city_cache:
+                city_cache[from_city] = from_city.lower()
+            from_city_name = city_cache[from_city]
+            
+            to_city = fly["to"]
+            if to_city not in city_cache:
+                city_cache[to_city] = to_city.lower()
+            to_city_name = city_cache[to_city]
+            
+            start_date = fly['start_date']
+            if start_date not in date_cache:
+                date_cache[start_date] = start_date.strftime("%d-%m-%Y")
+            departure_date = date_cache[start_date]
+            
+            trip=fly["trip"]
             
-        children_num = fly['children']
-        adults_num = fly['adults']
+            parts = [http_head,
+                     "&leg1=", self.createleg(from_city_name, to_city_name, departure_date),
+                     '&trip=', trip]
+            
+            if trip=="roundtrip":
+                return_date = fly['return_date']
+                if return_date not in date_cache:
+                    date_cache[return_date] = return_date.strftime("%d-%m-%Y")
+                parts.append('&leg2=')
+                parts.append(self.createleg(to_city_name, from_city_name, date_cache[return_date]))
+            
+            tail_key = (fly['children'], fly['adults'], fly['cabinclass'])
+            if tail_key not in tail_cache:
+                tail_cache[tail_key] = self.createtail(*tail_key)
+            parts.append(tail_cache[tail_key])
+            
+            url_list.append(''.join(parts))
         
+        return url_list
+    
+    def createtail(self,children_num,adults_num,cabinclass):
+        """
+        Create the passengers and options part of the url
+        """
         if children_num > 0:
             passengers='children:'+ str(children_num) + '[8]' + ','
         else:
@@ -57,18 +94,10 @@ class ExpediaReqURL():
         passengers += 'adults:'+ str(adults_num) +','
         passengers += 'infantinlap:N'
         
-        options='cabinclass:'+fly['cabinclass']
+        options='cabinclass:'+cabinclass
 #         origref='www.expedia.com.au%2FFlight-Search-All'
         
-        url = http_head + "&leg1=" + leg1
-        url += '&trip=' + trip
-        if len(leg2) > 0:
-            url += '&leg2=' + leg2
-        url += '&passengers=' + passengers
-        url += '&options=' + options
-#         url += '&origref=' + origref
-        
-        return url
+        return '&passengers=' + passengers + '&options=' + options
     
     def createleg(self,from_city_name,to_city_name,departure_date):
         leg = "from:"+from_city_name+","
@@ -88,8 +117,32 @@ class ExpediaReqURL():
     
         return anotherTime.strftime(dateFormat)
 
+def test():
+    u = ExpediaReqURL()
+    fly = {'from':'Sydney, NSW, Australia (SYD-All Airports)',
+           'to':'Beijing, China (BJS-All Airports)',
+           'trip':'roundtrip',
+           'start_date':datetime.date(2017,2,1),
+           'return_date':datetime.date(2017,2,8),
+           'adults':1,
+           'children':0,
+           'cabinclass':'economy'}
+    print(u.createURL(**fly))
+    
+    flight_list = []
+    for i in range(180*30):
+        f = dict(fly)
+        f['start_date'] = fly['start_date']+datetime.timedelta(i%180)
+        f['return_date'] = f['start_date']+datetime.timedelta(7)
+        flight_list.append(f)
+    t1 = datetime.datetime.now()
+    url_list = u.createURLList(flight_list)
+    t2 = datetime.datetime.now()
+    print("created %d urls in %s" %(len(url_list),t2-t1))
+
 def main():
     print("main")
+    test()
 
 
 
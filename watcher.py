@@ -0,0 +1,181 @@
+#!/usr/local/bin/python3
+# Copyright (C) 2015-2025 Wang,Jing   <jingwangian@gmail.com>
+#
+# This file is part of Flight Inforation Query System (fiqs)
+#
+# fiqs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fiqs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fiqs.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# inotify event masks, see <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+
+event_header = struct.Struct('iIII')
+
+class InotifyWatcher():
+    """
+    Report the files renamed into or written in a directory with inotify.
+    Recorder.finish renames res_xxx._xt to res_xxx.txt, which is an
+    IN_MOVED_TO event of the .txt name.
+    suffix is a string or a tuple of strings, as for str.endswith.
+    """
+    def __init__(self, dir_name, suffix='.txt'):
+        self.dir_name = dir_name
+        self.suffix = suffix
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(dir_name), IN_MOVED_TO|IN_CLOSE_WRITE)
+        if wd < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch %s failed" %dir_name)
+        self.overflow = False
+
+    def wait(self, timeout):
+        """
+        Wait at most timeout seconds and return the list of new files.
+        If the kernel queue overflowed, self.overflow is set and the caller
+        has to scan the directory once.
+        """
+        r,w,x = select.select([self.fd],[],[],timeout)
+        if len(r) == 0:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+
+        file_list = []
+        i = 0
+        while i+event_header.size <= len(data):
+            wd,mask,cookie,name_len = event_header.unpack_from(data, i)
+            i += event_header.size
+            name = data[i:i+name_len].rstrip(b'\0').decode()
+            i += name_len
+            if mask & IN_Q_OVERFLOW:
+                self.overflow = True
+            elif name.endswith(self.suffix):
+                file_list.append(os.path.join(self.dir_name, name))
+        return file_list
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher():
+    """
+    Fallback for the systems without inotify: list the directory every
+    interval seconds and report the names not seen before.
+    """
+    def __init__(self, dir_name, suffix='.txt', interval=5):
+        self.dir_name = dir_name
+        self.suffix = suffix
+        self.interval = interval
+        self.seen = set(self.list_files())
+        self.overflow = False
+
+    def list_files(self):
+        file_list = []
+        for entry in os.scandir(self.dir_name):
+            if entry.name.endswith(self.suffix):
+                file_list.append(os.path.join(self.dir_name, entry.name))
+        return file_list
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        current = set(self.list_files())
+        file_list = list(current-self.seen)
+        self.seen = current
+        return file_list
+
+    def close(self):
+        pass
+
+def create_watcher(dir_name, suffix='.txt'):
+    """
+    Return an InotifyWatcher on Linux, a PollingWatcher otherwise.
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(dir_name, suffix)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(dir_name, suffix)
+
+class PendingFiles():
+    """
+    The result files waiting for ingestion, kept incrementally from the
+    watcher events after one scan at start.
+    """
+    def __init__(self, dir_name, suffix='.txt'):
+        self.dir_name = dir_name
+        self.suffix = suffix
+        self.watcher = create_watcher(dir_name, suffix)
+        self.pending = set()
+        self.scan()
+
+    def scan(self):
+        for entry in os.scandir(self.dir_name):
+            if entry.name.endswith(self.suffix):
+                self.pending.add(os.path.join(self.dir_name, entry.name))
+
+    def wait(self, timeout):
+        """
+        Wait for new files and return the number of pending files.
+        """
+        self.pending.update(self.watcher.wait(timeout))
+        if self.watcher.overflow == True:
+            self.watcher.overflow = False
+            self.scan()
+        return len(self.pending)
+
+    def take(self, sort_key=None):
+        """
+        Return all pending files sorted by sort_key and forget them.
+        """
+        file_list = sorted(self.pending, key=sort_key)
+        self.pending = set()
+        return file_list
+
+    def close(self):
+        self.watcher.close()
+
+def test():
+    import tempfile
+    d = tempfile.mkdtemp()
+    pf = PendingFiles(d)
+    print("watcher: %s" %type(pf.watcher).__name__)
+    for i in range(3):
+        name = os.path.join(d, "res_20160602_%d._xt" %i)
+        with open(name,'w') as f:
+            f.write('x')
+        os.rename(name, name[:-4]+".txt")
+    t1 = time.time()
+    pf.wait(5)
+    print("%d pending after %.3f seconds: %s" %(len(pf.pending),time.time()-t1,pf.take()))
+    pf.close()
+
+def main():
+    test()
+
+if __name__=='__main__':
+    main()
@@ -19,10 +19,13 @@
 import sys
 import logging
 import time
+import queue
 import datetime
 import multiprocessing as mp
 from enum import Enum
 
+import ratelimit
+import proxy_pool
 import worker_exec as wke
 
 
@@ -49,6 +52,10 @@ class WorkerMonitor():
         self.task_q = None
         self.result_q = None
         self.stat_q = None
+        self.page_q = None
+        self.limiter = None
+        self.controller = None
+        self.proxy_pool = None
         self.handle = None
         self.worker_list = []
         
@@ -58,6 +65,36 @@ class WorkerMonitor():
         self.stat_q=mp.Queue()
         return (self.task_q,self.result_q)
         
+    def create_page_queue(self, maxsize):
+        """
+        Create the bounded queue of the direct pipeline mode, the workers
+        put the parsed pages into it instead of writing result files.
+        """
+        self.page_q = mp.Queue(maxsize)
+        return self.page_q
+        
+    def create_flow_control(self, rate, burst, initial, max_num, target_latency, max_error_rate):
+        """
+        Create the flow control shared by the workers: at most rate pages
+        per second (no limit if rate is 0) and from 1 to max_num pages in
+        flight, starting from initial, see ratelimit.AIMDController.
+        """
+        if rate > 0:
+            self.limiter = ratelimit.TokenBucket(rate, burst)
+        self.controller = ratelimit.AIMDController(initial, 1, max_num,
+                                                   target_latency, max_error_rate,
+                                                   name='[flow]')
+        return self.controller
+        
+    def create_proxy_pool(self, proxy_list):
+        """
+        Create the proxy pool shared by the drivers of the workers, see
+        proxy_pool.ProxyPool. An empty list makes the drivers go direct.
+        """
+        if len(proxy_list) > 0:
+            self.proxy_pool = proxy_pool.ProxyPool(proxy_list)
+        return self.proxy_pool
+        
     def start_monitor(self):
         print("Enter into start_monitor")
         if self.handle != None:
@@ -87,10 +124,20 @@ class WorkerMonitor():
         print("Enter into start_workers")
         for i in range(num):
             wk_num = i+1
-            wk = Worker(wk_num,self.task_q,self.result_q,self.stat_q)
+            wk = Worker(wk_num,self.task_q,self.result_q,self.stat_q,self.page_q,
+                        self.limiter,self.controller,self.proxy_pool)
             wk.start()
             self.worker_list.append(wk)
         
+    def join_workers(self, timeout):
+        """
+        Wait at most timeout seconds for all workers to exit by themselves.
+        """
+        end_time = time.time()+timeout
+        for wk in self.worker_list:
+            if wk.handle != None:
+                wk.handle.join(max(0,end_time-time.time()))
+
     def stop_workers(self):
         """
         Stop all workers
@@ -99,16 +146,20 @@ class WorkerMonitor():
             wk.terminate()
     
 class Worker():
-    def __init__(self, num, task_q, result_q, stat_q):
+    def __init__(self, num, task_q, result_q, stat_q, page_q=None, limiter=None, controller=None,
+                 proxies=None):
         print("Enter worker init")
         self.num = num
+        self.page_q = page_q  #The queue of the parsed pages in the direct pipeline mode
+        self.limiter = limiter  #The shared flow control, see WorkerMonitor.create_flow_control
+        self.controller = controller
+        self.proxies = proxies  #The shared proxy_pool.ProxyPool of the drivers
         self.task_q = task_q   #The queue to receive the command and task
         self.stat_q = stat_q  #The queue to check the worker status
         self.result_q = result_q
         self.status = WorkerStatus.not_start
         self.handle = None
         self.no_heartbeat_times=0
-        self.driver = None
         
     def getWorkersNum(self):
         return self.num
@@ -117,8 +168,8 @@ class Worker():
         print("enter worker.start")
         try:
             print("Creating worker process")
-            self.driver = wke.createDriver()
-            p = mp.Process(target=wke.execTask, args=(self.task_q, self.result_q, self.stat_q, self.num,self.driver))
+            p = mp.Process(target=wke.execTask, args=(self.task_q, self.result_q, self.stat_q, self.num, self.page_q,
+                                                      self.limiter, self.controller, self.proxies))
             self.handle = p
             self.status = WorkerStatus.running;
             self.no_heartbeat_times = 0
@@ -132,9 +183,6 @@ class Worker():
     
     def terminate(self):
         print("Worker[%d] is terminated" %self.num)
-        if self.driver != None:
-            self.driver.quit()
-            self.driver = None
         self.status = WorkerStatus.not_start
         self.handle.terminate()
         self.heartbeat = False
@@ -156,6 +204,7 @@ def monitor_exec(worker_list,stat_q):
         return;
     
     max_heartbeat_times = 3
+    heartbeat_interval = 20
 
     while(1):
         for wk in worker_list:
@@ -164,14 +213,13 @@ def monitor_exec(worker_list,stat_q):
                 wk.terminate()
                 wk.start()            
         
-        if stat_q.empty() == True:
-            time.sleep(20)
+        try:
+            num = stat_q.get(timeout=heartbeat_interval)
+        except queue.Empty:
             for wk in worker_list:
                 wk.no_heartbeat_times = wk.no_heartbeat_times+1
             continue
         
-        num = stat_q.get()
-        
         for wk in worker_list:
             if wk.num == num:
                 wk.no_heartbeat_times=0
@@ -17,6 +17,9 @@
 # along with fiqs.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
+import queue
+import signal
+import socket
 import logging
 import time
 import datetime
@@ -24,6 +27,8 @@ import url
 import db
 import selenium
 import recorder
+import result
+import archive
 
 from selenium import webdriver
 from selenium.webdriver.common.by import By
@@ -33,56 +38,123 @@ from selenium.webdriver.common.proxy import *
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 from recorder import Recorder
+from readiness import ReadinessChecker
+from driver_pool import DriverPool
+from selenium.common.exceptions import WebDriverException
 
 worker_name=["worker_0"]
 
 worker_logger=None
 
-myProxy = "127.0.0.1:3128"
+# Wait for the result page with the default readiness strategies, the
+# wait budget of every route adapts to its observed time-to-ready.
+ready_checker = ReadinessChecker()
 
-proxy = Proxy({
-    'proxyType': ProxyType.MANUAL,
-    'httpProxy': myProxy,
-    'ftpProxy': myProxy,
-    'sslProxy': myProxy,
-    'noProxy': '' # set this value as desired
-    })
+# Every worker keeps g_driver_spares warm drivers, and recycles its driver
+# after g_driver_max_tasks tasks or above g_driver_max_rss_mb MB of RSS.
+g_driver_spares = 1
+g_driver_max_tasks = 100
+g_driver_max_rss_mb = 1500
+
+# Queue of the direct pipeline mode, every item is a tuple
+# (flight_id, search_date, flight_list) for result.pipeline_writer_exec
+page_q = None
+
+# Save the raw pages into result files also in the direct pipeline mode
+g_archive_pages = False
+
+# 'segment' appends the pages of a worker into segment files in results/,
+# see archive.SegmentWriter; 'file' writes one result file per page.
+# A segment is sealed for ingestion after g_segment_max_records pages or
+# g_segment_max_age seconds.
+g_page_store = 'segment'
+g_segment_max_records = 200
+g_segment_max_age = 60
+page_writer = None
+
+# Shared flow control set by execTask: a ratelimit.TokenBucket of the
+# pages per second and a ratelimit.AIMDController of the pages in flight
+# of all workers, None for no limit
+rate_limiter = None
+concurrency_controller = None
+heartbeat_q = None
+
+# Compare the sha1 of every page with the last page of the flight, an
+# unchanged page is not saved nor parsed, see page_unchanged
+g_page_fingerprint = True
+
+# A 'claim' command makes the worker claim g_claim_batch_size tasks at a
+# time from flight_price_query_task, see FlightPlanDatabase.claim_tasks
+g_claim_batch_size = 5
+g_claim_lease_seconds = 600
+
+# An idle worker sends a heartbeat when no task came in this many seconds
+g_heartbeat_interval = 10
+
+# The shared proxy_pool.ProxyPool set by execTask, every driver uses the
+# proxy it got at creation until it is recycled; None to go direct
+proxy_pool = None
+
+# A page containing one of these is the site refusing the proxy, which
+# is then banned for a while
+g_ban_markers = ('Access Denied', 'unusual traffic', 'are you a robot')
+
+def make_proxy(address):
+    return Proxy({
+        'proxyType': ProxyType.MANUAL,
+        'httpProxy': address,
+        'ftpProxy': address,
+        'sslProxy': address,
+        'noProxy': '' # set this value as desired
+        })
 
 def createDriver():
-#    driver = webdriver.Firefox(proxy=proxy)
+    """
+    Create a Firefox driver through a proxy of proxy_pool, the number of
+    the proxy is kept in driver.proxy_num.
+    """
+    n = None
+    if proxy_pool != None:
+        n = proxy_pool.acquire()
     
-    driver = webdriver.Firefox()
+    if n == None:
+        driver = webdriver.Firefox()
+    else:
+        try:
+            driver = webdriver.Firefox(proxy=make_proxy(proxy_pool.address(n)))
+        except:
+            proxy_pool.release(n)
+            raise
+    driver.proxy_num = n
     return driver
 
 def closeDriver(driver):
 #     driver.close()
-    driver.quit()
+    try:
+        driver.quit()
+    finally:
+        if proxy_pool != None:
+            proxy_pool.release(getattr(driver,'proxy_num',None))
     
 def runDriver(driver,url,id):
     global worker_logger
+    global ready_checker
     
-#     t1 = datetime.datetime.now()
     driver.get(url)
     ret = True
-#     t2 = datetime.datetime.now()
-#     tx = t2-t1
-#     worker_logger.info("%s driver.get cost %d seconds for id[%d]" %(worker_name,tx.seconds,id))
     try:
-        t1 = datetime.datetime.now()
-        time.sleep(15)
-        element = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, "feedbackAndImprovements")))
-        t2 = datetime.datetime.now()
-        tx = t2-t1
-        worker_logger.info("%s WebDriverWait cost %d seconds" %(worker_name,tx.seconds))
-    except TimeoutException as tterr:
-        worker_logger.info("%s Time out for get URL[%d]" %(worker_name,id))
-        ret = False
+        ready,seconds,strategy = ready_checker.wait(driver,url)
+        if ready == True:
+            worker_logger.info("%s Page ready in %.1f seconds for id[%d]" %(worker_name,seconds,id))
+        else:
+            worker_logger.info("%s Time out in %s after %.1f seconds for get URL[%d]" %(worker_name,strategy,seconds,id))
+            ret = False
     except Exception as err:
         print("error ",err)
     finally:
         return ret
 
-def execTask(task_q,result_q, stat_q,num,driver):
+def execTask(task_q,result_q, stat_q,num,pipe_q=None,limiter=None,controller=None,proxies=None):
     """
     Execute task coming from the task_q squeue.
     Input Parameters:
@@ -90,56 +162,176 @@ def execTask(task_q,result_q, stat_q,num,driver):
         result_q: The queue for the worker return task state.
         stat_q: The queue for the worker_monitor check the worker hearbeat.
         num : type[int], the worker number.
-        driver: the web driver.
+        pipe_q: the queue of the direct pipeline mode, None to save the
+            pages into result files.
+        limiter, controller: the shared ratelimit.TokenBucket and
+            ratelimit.AIMDController, see fetch_flight_price.
+        proxies: the shared proxy_pool.ProxyPool of the drivers.
+    The web drivers are owned by a DriverPool living in this process.
+    A task message is {'cmd':'continue','data':flight_id,'date':date,
+    'url':url,'flight':flight}, where url and flight are optional; a
+    {'cmd':'claim','date':date} message lets the worker claim the tasks
+    from the database and put None into result_q when none is left.
     """
     global worker_name
     global worker_logger
+    global page_q
+    global rate_limiter
+    global concurrency_controller
+    global heartbeat_q
+    global proxy_pool
     
     worker_name = "[worker_"+str(num)+"]"
+    page_q = pipe_q
+    rate_limiter = limiter
+    concurrency_controller = controller
+    heartbeat_q = stat_q
+    proxy_pool = proxies
     worker_logger= logging.getLogger('[Worker]')
     worker_logger.info(worker_name+" started")
     print(worker_name, " started")
     
+    # SIGTERM from Worker.terminate must still run the finally below,
+    # otherwise the browsers of the pool are left behind.
+    signal.signal(signal.SIGTERM, exit_on_signal)
+    
+    node_id = socket.gethostname()
+    
     mydb = db.FlightPlanDatabase()
     mydb.connectDB()
     
-#     driver = createDriver()
+    pool = DriverPool(createDriver, closeDriver,
+                      spares=g_driver_spares,
+                      max_tasks=g_driver_max_tasks,
+                      max_rss_mb=g_driver_max_rss_mb,
+                      name=worker_name)
+    pool.start()
     
     try:
         while(1):
-            if task_q.empty() == True:
-                time.sleep(10)
+            try:
+                d = task_q.get(timeout=g_heartbeat_interval)
+            except queue.Empty:
+                # Idle worker still reports it is alive
+                stat_q.put(num)
+                mydb.flush_status_in_flight_price_query_task_tbl()
+                if page_writer != None:
+                    page_writer.seal_if_due()
                 continue
-            d = task_q.get()
             
             if d['cmd']=='exit':
                 break
             
-            t1 = datetime.datetime.now()
-            flight_id = d['data']
-            search_date=d['date']
-#             print("%s Start handle task with flight id %d" %(worker_name,flight_id))
-            worker_logger.info("%s Start handle task with flight id %d" %(worker_name,flight_id))
-            
-            result_q.put(flight_id)
-            
-            req_url = mydb.get_flight_url_by_id(flight_id)
-            mydb.update_status_in_flight_price_query_task_tbl(flight_id,1,search_date)
-            
-            worker_logger.info("%s send url : %s\n" %(worker_name,req_url))
-            
-            getFlightPrice(driver, req_url,flight_id, num)
+            if d['cmd']=='claim':
+                # Claim the tasks from the database until there is none left
+                claim_num = 0
+                while(1):
+                    task_list = mydb.claim_tasks(node_id, num, g_claim_batch_size, g_claim_lease_seconds)
+                    if len(task_list) == 0:
+                        break
+                    task_dict = mydb.get_flight_url_by_ids(task_list)
+                    done_list = []
+                    for flight_id in task_list:
+                        try:
+                            req_url = task_dict[flight_id]['url']
+                            if handle_task(mydb, pool, flight_id, d['date'], num, False, req_url) == True:
+                                done_list.append(flight_id)
+                        except Exception as err:
+                            # The task is claimed again when its lease expired
+                            worker_logger.info("%s Failed to handle flight id %d: %s" %(worker_name,flight_id,err))
+                        result_q.put(flight_id)
+                        stat_q.put(num)
+                    # The crawled pages are handed to the ingestion, which
+                    # sets their status
+                    mydb.end_task_leases(done_list, d['date'])
+                    claim_num += len(task_list)
+                worker_logger.info("%s No task left to claim, %d tasks claimed" %(worker_name,claim_num))
+                result_q.put(None)
+                continue
             
-            t2 = datetime.datetime.now()
-            tx = t2-t1
-            worker_logger.info("%s End handle task flight id %d with time [%s] seconds" %(worker_name,flight_id, tx.seconds))
-#             print("%s End handle task flight id %d with time [%s] seconds" %(worker_name,flight_id, tx.seconds))
+            flight_id = d['data']
+            try:
+                handle_task(mydb, pool, flight_id, d['date'], num, True, d.get('url'))
+            finally:
+                # Tell main the task is finished, even if it failed
+                result_q.put(flight_id)
             
             stat_q.put(num)
     finally:
-#         closeDriver(driver)
+        pool.close()
+        close_page_writer()
+        mydb.disconnectDB()
         logging.info(worker_name+" exited")
 
+def handle_task(mydb, pool, flight_id, search_date, num, set_status=True, req_url=None):
+    """
+    Get the result page of one flight with a driver of the pool.
+    set_status: set the task status to 1 first, not needed for a task
+    which was claimed from the database.
+    req_url: the url hydrated by the dispatcher, it is read from the
+    database only when it is None.
+    Return True if the page got ready.
+    """
+    t1 = datetime.datetime.now()
+    worker_logger.info("%s Start handle task with flight id %d" %(worker_name,flight_id))
+    
+    if req_url == None:
+        req_url = mydb.get_flight_url_by_id(flight_id)
+    if set_status == True:
+        mydb.queue_status_in_flight_price_query_task_tbl(flight_id,1,search_date)
+    
+    worker_logger.info("%s send url : %s\n" %(worker_name,req_url))
+    
+    try:
+        ok = fetch_flight_price(pool, req_url,flight_id, num, mydb)
+    except WebDriverException as err:
+        # The driver is broken, run the task again on a fresh one
+        worker_logger.info("%s driver failed on flight id %d: %s" %(worker_name,flight_id,err))
+        pool.replace_driver("driver error")
+        ok = fetch_flight_price(pool, req_url,flight_id, num, mydb)
+    
+    t2 = datetime.datetime.now()
+    tx = t2-t1
+    worker_logger.info("%s End handle task flight id %d with time [%s] seconds" %(worker_name,flight_id, tx.seconds))
+    return ok
+
+def fetch_flight_price(pool, url, id, worker_num, mydb=None):
+    """
+    getFlightPrice with the driver of the pool under the shared flow
+    control: wait for a token of rate_limiter and a slot of
+    concurrency_controller, then report the page latency and whether it
+    got ready to the controller and to the proxy of the driver. A worker
+    waiting for a slot still sends its heartbeat.
+    The driver is recycled when its proxy got banned, the next one gets
+    a healthier proxy.
+    """
+    driver = pool.get_driver()
+    if rate_limiter != None:
+        rate_limiter.acquire()
+    if concurrency_controller != None:
+        while concurrency_controller.acquire(g_heartbeat_interval) == False:
+            heartbeat_q.put(worker_num)
+    
+    t1 = time.time()
+    ok = False
+    banned = False
+    try:
+        ok,banned = getFlightPrice(driver, url, id, worker_num, mydb)
+    finally:
+        latency = time.time()-t1
+        if concurrency_controller != None:
+            concurrency_controller.release(latency, ok)
+        if proxy_pool != None:
+            proxy_pool.report(driver.proxy_num, latency, ok, banned)
+    
+    pool.task_done()
+    if proxy_pool != None and proxy_pool.is_banned(driver.proxy_num):
+        pool.replace_driver("proxy %s banned" %proxy_pool.address(driver.proxy_num))
+    return ok
+
+def exit_on_signal(signum, frame):
+    sys.exit(0)
+
 def get_flight_info_from_flight_module_element(flight_module_element):
     """
     return a tuple cotains:
@@ -157,50 +349,136 @@ def get_flight_info_from_flight_module_element(flight_module_element):
     
     return price,company_name
     
-def getFlightPrice(driver, url, id, worker_num):
+def getFlightPrice(driver, url, id, worker_num, mydb=None):
     """
     This function send url to remote server and get the result.
-    Save the result into file.
+    Save the result into file, or in the direct pipeline mode parse it
+    and put the fares into page_q.
     Input parameter: 
         dirver: The web driver.
         url: type[string] . The url address.
         id: type[int] The flight id.
         worker_num: type[int] the worker number.
+        mydb: the database of the worker, the page fingerprint is checked
+            when it is given.
+    Return a tuple (ok, banned): ok True if the result page got ready,
+    banned True if the site refused the proxy of the driver.
     """
 #     flight_module_class_name='flight-module.segment.offer-listing'
 
         
+    if runDriver(driver,url,id)==True:
+        body_element = driver.find_element_by_tag_name('body')
+        text = body_element.text
+        if page_blocked(text) == True:
+            worker_logger.info("%s Page of flight id %d blocked by the site" %(worker_name,id))
+            return False,True
+        if page_unchanged(mydb, id, text) == True:
+            worker_logger.info("%s Page of flight id %d unchanged, not saved" %(worker_name,id))
+            return True,False
+        if page_q != None:
+            # Direct pipeline, parse here and send the fares to the writer
+            search_date = datetime.date.today().strftime('%Y-%m-%d')
+            flight_list = result.parse_page_text(text, str(id), search_date)
+            page_q.put((str(id), search_date, flight_list, page_fingerprint(text)))
+        if page_q == None or g_archive_pages == True:
+            save_page(id, url, worker_num, text)
+        return True,False
+    else:
+        print("worker[%d] failed to handle flight_id[%d]" %(worker_num, id))
+        return False,False
+
+def page_blocked(text):
+    """
+    Return True if the page is the site refusing the request instead of a
+    search result.
+    """
+    if 'Result ' in text:
+        return False
+    for marker in g_ban_markers:
+        if marker in text:
+            return True
+    return False
+
+def page_fingerprint(text):
+    return result.page_fingerprint(text.encode())
+
+def page_unchanged(mydb, id, text):
+    """
+    Return True if the page of flight id is the same as the last one
+    stored. Its task is then set finished: the fares are the ones stored
+    for the date in flight_page_fingerprint.unchanged_since.
+    The fingerprint is only read here, the result process stores it once
+    the fares of the page are committed.
+    A page without any result is never taken as unchanged, so a failed
+    search is still stored and seen by the result process.
+    """
+    if mydb == None or g_page_fingerprint == False or 'Result ' not in text:
+        return False
+    search_date = datetime.date.today()
+    since = mydb.check_page_fingerprint(id, page_fingerprint(text), search_date)
+    if since != None and since < search_date:
+        mydb.queue_status_in_flight_price_query_task_tbl(id, 2, search_date)
+        return True
+    return False
+
+def save_page(id, url, worker_num, text):
+    """
+    Save one result page into the segment of this process, or into the
+    result file through Recorder when g_page_store is 'file'.
+    The file starts with the <flight_id>, <url>, <search_date> and
+    <worker_num> header lines followed by the page text, which is the
+    format result.analyze_one_file expects.
+    Input parameter:
+        id: type[int] The flight id.
+        url: type[string] . The url address.
+        worker_num: type[int] the worker number.
+        text: type[string] the text of the result page.
+    """
+    global page_writer
+    
+    if g_page_store == 'segment':
+        if page_writer == None:
+            page_writer = archive.SegmentWriter('results',
+                                                max_records=g_segment_max_records,
+                                                max_age=g_segment_max_age)
+        t = datetime.datetime.now().strftime("%Y-%m-%d %H %M %S")
+        page_writer.append(id, url, t, worker_num, text)
+        return
+    
     flight_id=str(id)
     
     re = Recorder(flight_id,recorder.RecorderMode.binary)
     
-    if runDriver(driver,url,id)==True:
-        #Write the fight id.
-        flight_id="<flight_id>"+flight_id
-        re.writeN(flight_id)
-        
-        #Write the url
-        re.write("<url>")
-        re.writeN(url)
-        
-        #Write the search date
-        t = datetime.datetime.now().strftime("%Y-%m-%d %H %M %S")
-        search_date = "<search_date>"+t
-        re.writeN(search_date)
+    #Write the fight id.
+    flight_id="<flight_id>"+flight_id
+    re.writeN(flight_id)
+    
+    #Write the url
+    re.write("<url>")
+    re.writeN(url)
+    
+    #Write the search date
+    t = datetime.datetime.now().strftime("%Y-%m-%d %H %M %S")
+    search_date = "<search_date>"+t
+    re.writeN(search_date)
 
-        #Write the worker number
-        re.write("<worker_num>")
-        re.writeN(str(worker_num))
+    #Write the worker number
+    re.write("<worker_num>")
+    re.writeN(str(worker_num))
 
-          
-        time.sleep(1)
-        body_element = driver.find_element_by_tag_name('body')
-        re.writeN(body_element.text)
+    re.writeN(text)
+    re.finish()
 
-        time.sleep(1)
-        re.finish()
-    else:
-        print("worker[%d] failed to handle flight_id[%d]" %(worker_num, id))
+def close_page_writer():
+    """
+    Seal the open segment so the result process ingests it.
+    """
+    global page_writer
+    
+    if page_writer != None:
+        page_writer.close()
+        page_writer = None
 
 def get_urls_from_file(filename):
     """